@@ -1,16 +1,29 @@
 # app/main.py
-from fastapi import FastAPI, File, UploadFile, Form, HTTPException, Depends
+from fastapi import FastAPI, HTTPException, Depends, Request
 from fastapi.responses import HTMLResponse, JSONResponse
 from fastapi.staticfiles import StaticFiles
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
+from typing import Dict, List, Optional
+import asyncio
+import hashlib
+import io
+import os
+import re
 import shutil
 import logging
 import json
+import uuid
+
+import aiofiles
+from streaming_form_data import StreamingFormDataParser
+from streaming_form_data.parser import ParseFailedException
+from streaming_form_data.targets import BaseTarget, ValueTarget
 
 # Import your MetadataAnalyzer
-from src.metadata_analyzer import MetadataAnalyzer
+from src.metadata_analyzer import HASH_ALGORITHMS, MetadataAnalyzer
 # Import AI integrations
-from src.ai_integrations import generate_forensic_narrative, infer_device_profile, update_knowledge_base
+from src.ai_integrations import NarrativeBatcher, infer_device_profile, update_knowledge_base
 # Assuming you'll have PRNU modules later
 # from src.prnu_model import train_prnu_model, analyze_prnu
 
@@ -28,14 +41,206 @@ app.mount("/static", StaticFiles(directory="app/static"), name="static")
 # Initialize Metadata Analyzer
 metadata_analyzer = MetadataAnalyzer()
 
+# Narratives for concurrent analyses are generated together in one AI call
+narrative_batcher = NarrativeBatcher()
+
 # Directory for uploaded files
 UPLOAD_DIR = Path("uploads")
 UPLOAD_DIR.mkdir(exist_ok=True)
 
+# Metadata uploads up to this size are kept in memory and analyzed there;
+# larger ones are streamed to UPLOAD_DIR through a write buffer of this size.
+SPOOL_MAX_SIZE = 1024 * 1024
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Content types accepted for PRNU training images
+TRAINING_CONTENT_TYPES = ["image/jpeg", "image/png", "image/jpg"]
+
+# Characters stripped from device names before they are used as directory names
+UNSAFE_DEVICE_NAME_CHARS = re.compile(r"[^\w ]")
+
 # Directory for PRNU training data
 PRNU_TRAINING_DIR = Path("data/raw")
 PRNU_TRAINING_DIR.mkdir(parents=True, exist_ok=True)
 
+# Process pool for CPU-bound per-file metadata work, created on first use and
+# shared by all requests.
+_process_pool: Optional[ProcessPoolExecutor] = None
+
+# Upper bound on the files analyzed per pool task
+METADATA_BATCH_SIZE = 32
+
+
+def get_process_pool() -> ProcessPoolExecutor:
+    """Returns the shared metadata process pool, creating it on first use."""
+    global _process_pool
+    if _process_pool is None:
+        _process_pool = ProcessPoolExecutor(max_workers=os.cpu_count())
+    return _process_pool
+
+
+def _analyze_files_worker(file_paths: List[str], hash_values: List[Optional[dict]]) -> List[dict]:
+    """Runs in a pool worker, analyzing a whole batch with that process's own MetadataAnalyzer."""
+    return metadata_analyzer.analyze_files(file_paths, hash_values)
+
+
+def _analyze_file_worker(file_path: str, hash_values: Optional[dict]) -> dict:
+    """Runs in a pool worker, analyzing one file on disk; errors propagate to the caller."""
+    return metadata_analyzer.analyze_file(file_path, hash_values)
+
+
+def _analyze_bytes_worker(data: bytes, file_name: str, hash_values: Optional[dict]) -> dict:
+    """Runs in a pool worker, analyzing an upload that was kept in memory."""
+    return metadata_analyzer.analyze_stream(io.BytesIO(data), file_name, hash_values)
+
+
+async def process_file_parallel(paths: List[str], hash_values: Optional[List[dict]] = None) -> List[dict]:
+    """
+    Extracts metadata (EXIF, hashes, perceptual hash) for many files across CPU cores
+    without blocking the event loop. A failing file yields an {'error': ...} entry.
+    Hashes already computed while the files were written can be passed in hash_values.
+    Files are sent to the workers in batches of up to METADATA_BATCH_SIZE.
+    """
+    loop = asyncio.get_running_loop()
+    pool = get_process_pool()
+    hash_values = hash_values or [None] * len(paths)
+    # Spread small uploads over every worker; cap the batch size for large ones
+    batch_size = max(1, min(METADATA_BATCH_SIZE, -(-len(paths) // (os.cpu_count() or 1))))
+    batches = [slice(start, start + batch_size) for start in range(0, len(paths), batch_size)]
+    results = await asyncio.gather(
+        *(loop.run_in_executor(pool, _analyze_files_worker, paths[batch], hash_values[batch]) for batch in batches),
+        return_exceptions=True
+    )
+    reports = []
+    for batch, result in zip(batches, results):
+        if isinstance(result, Exception):
+            reports.extend({'error': str(result)} for _ in paths[batch])
+        else:
+            reports.extend(result)
+    return reports
+
+
+class _UploadTarget(BaseTarget):
+    """
+    streaming-form-data target that stores every file part of a form field.
+
+    Each part is written under ``directory`` with aiofiles, unless it
+    fits in ``max_in_memory`` bytes, in which case it is kept in memory. Parts whose
+    content type is not in ``allowed_content_types`` are discarded unread.
+    Every byte is hashed as it is received, so the stored file never has to be
+    read back to fingerprint it. Stored parts are collected in ``parts`` as dicts
+    with ``filename``, ``content_type``, ``size``, ``hash_values`` (one hex digest
+    per HASH_ALGORITHMS entry) and either ``path`` or ``data``.
+    """
+
+    def __init__(self, directory: Path, allowed_content_types: Optional[List[str]] = None,
+                 max_in_memory: int = 0):
+        super().__init__()
+        self.directory = directory
+        self.allowed_content_types = allowed_content_types
+        self.max_in_memory = max_in_memory
+        self.parts: List[dict] = []
+        self.skipped: List[dict] = []
+        self._filename = ""
+        self._pending = False
+        self._part: Optional[dict] = None
+        self._hashers = []
+        self._buffer = bytearray()
+        self._fd = None
+
+    async def on_start_async(self):
+        # Keep only the base name; the client-supplied value may contain a path
+        self._filename = Path(self.multipart_filename or "").name
+        self._part = None
+        self._pending = True
+
+    def _begin_part(self):
+        # The parser reports a part's Content-Type only after starting it, so the
+        # part is accepted or skipped once its first data (or its end) arrives
+        self._pending = False
+        content_type = self.multipart_content_type
+        self.multipart_content_type = None  # Do not leak into the next part
+        if not self._filename:
+            return  # Empty file input
+        if self.allowed_content_types is not None and content_type not in self.allowed_content_types:
+            self.skipped.append({"filename": self._filename, "content_type": content_type})
+            return
+        self._part = {"filename": self._filename, "content_type": content_type, "path": None, "data": None, "size": 0}
+        self._hashers = [hashlib.new(algorithm) for algorithm in HASH_ALGORITHMS]
+        self._buffer = bytearray()
+
+    async def on_data_received_async(self, chunk: bytes):
+        if self._pending:
+            self._begin_part()
+        if self._part is None:
+            return
+        self._part["size"] += len(chunk)
+        for hasher in self._hashers:
+            hasher.update(chunk)
+        if self._fd is None:
+            if len(self._buffer) + len(chunk) <= self.max_in_memory:
+                self._buffer += chunk
+                return
+            await self._open_part_file()
+        await self._fd.write(chunk)
+
+    async def on_finish_async(self):
+        if self._pending:
+            self._begin_part()
+        if self._part is None:
+            return
+        if self._fd is None and self.max_in_memory == 0:
+            await self._open_part_file()  # Empty part, but callers expect a file
+        if self._fd is not None:
+            await self._fd.close()
+            self._fd = None
+        else:
+            self._part["data"] = bytes(self._buffer)
+        self._part["hash_values"] = {hasher.name: hasher.hexdigest() for hasher in self._hashers}
+        self._buffer = bytearray()
+        self.parts.append(self._part)
+        self._part = None
+
+    async def _open_part_file(self):
+        # A private subdirectory per part keeps the original file name without collisions
+        part_dir = self.directory / uuid.uuid4().hex
+        part_dir.mkdir(parents=True)
+        path = part_dir / self._part["filename"]
+        self._part["path"] = path
+        self._fd = await aiofiles.open(path, "wb", buffering=UPLOAD_CHUNK_SIZE)
+        if self._buffer:
+            await self._fd.write(bytes(self._buffer))
+        self._buffer = bytearray()
+
+    async def cleanup(self):
+        """Closes any half-written part and deletes every file this target wrote."""
+        if self._fd is not None:
+            await self._fd.close()
+            self._fd = None
+        paths = [part["path"] for part in self.parts + ([self._part] if self._part else [])]
+        for path in paths:
+            if path is not None:
+                shutil.rmtree(path.parent, ignore_errors=True)
+
+
+async def _parse_multipart(request: Request, targets: Dict[str, BaseTarget]) -> None:
+    """Streams a multipart request body into the given targets, field by field."""
+    try:
+        parser = StreamingFormDataParser(headers=request.headers)
+        for name, target in targets.items():
+            parser.register(name, target)
+        async for chunk in request.stream():
+            await parser.adata_received(chunk)
+    except ParseFailedException as e:
+        raise HTTPException(status_code=400, detail=f"Malformed multipart upload: {e}")
+
+
+@app.on_event("shutdown")
+def shutdown_process_pool():
+    """Stops the metadata worker processes with the application."""
+    if _process_pool is not None:
+        _process_pool.shutdown(wait=False, cancel_futures=True)
+
 
 @app.get("/", response_class=HTMLResponse)
 async def read_root():
@@ -142,36 +347,52 @@ async def read_root():
     return HTMLResponse(content=html_content)
 
 @app.post("/analyze-metadata")
-async def analyze_metadata(file: UploadFile = File(...)):
+async def analyze_metadata(request: Request):
     """
     [span_25](start_span)Handles metadata forensics for a single uploaded file.[span_25](end_span)
     [span_26](start_span)Saves the file to a temporary, secure location.[span_26](end_span)
     [span_27](start_span)Executes the Metadata Forensics module.[span_27](end_span)
     [span_28](start_span)Returns the generated JSON report.[span_28](end_span)
     """
-    temp_file_path = UPLOAD_DIR / file.filename
+    upload = _UploadTarget(UPLOAD_DIR, max_in_memory=SPOOL_MAX_SIZE)
     try:
-        with open(temp_file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-        logging.info(f"Received file for metadata analysis: {temp_file_path}")
+        await _parse_multipart(request, {"file": upload})
+        if not upload.parts:
+            raise HTTPException(status_code=400, detail="No file was uploaded for metadata analysis.")
+        part = upload.parts[0]
 
-        # Execute the Metadata Forensics module
-        report = metadata_analyzer.analyze(temp_file_path)
+        # The analysis is CPU-bound (hashing, EXIF walk, pHash), so it runs in the
+        # shared process pool instead of blocking the event loop
+        loop = asyncio.get_running_loop()
+        if part["path"] is None:
+            # Small upload: analyze it in memory, it never touches disk
+            logging.info(f"Received file for metadata analysis: {part['filename']} ({len(part['data'])} bytes, in memory)")
+            report = await loop.run_in_executor(
+                get_process_pool(), _analyze_bytes_worker, part["data"], part["filename"], part["hash_values"]
+            )
+        else:
+            logging.info(f"Received file for metadata analysis: {part['path']}")
+
+            # Execute the Metadata Forensics module
+            report = await loop.run_in_executor(
+                get_process_pool(), _analyze_file_worker, str(part["path"]), part["hash_values"]
+            )
 
         # Generate final narrative using AI if needed (can be integrated into analyzer or here)
-        final_narrative = generate_forensic_narrative(report.get("forensic_narrative", []))
+        final_narrative = await narrative_batcher.submit(part["filename"], report.get("forensic_narrative", []))
         report["forensic_narrative_ai_generated"] = final_narrative
 
         return JSONResponse(content=report)
+    except HTTPException:
+        raise
     except Exception as e:
         logging.error(f"Error during metadata analysis: {e}")
         raise HTTPException(status_code=500, detail=f"Failed to analyze metadata: {e}")
     finally:
-        if temp_file_path.exists():
-            temp_file_path.unlink() # Clean up temporary file
+        await upload.cleanup() # Clean up temporary file
 
 @app.post("/upload-for-training")
-async def upload_for_training(device_name: str = Form(...), files: List[UploadFile] = File(...)):
+async def upload_for_training(request: Request):
     """
     [span_29](start_span)Handles PRNU data ingestion for training.[span_29](end_span)
     [span_30](start_span)Accepts images only (.jpg, .jpeg, .png).[span_30](end_span)
@@ -180,31 +401,46 @@ async def upload_for_training(device_name: str = Form(...), files: List[UploadFi
     [span_33](start_span)Uses Python's subprocess module to execute command-line scripts: preprocess.py, generate_triplets.py, and train.py.[span_33](end_span)
     [span_34](start_span)Returns a link to the final training run manifest (placeholder for now).[span_34](end_span)
     """
-    if not device_name:
-        raise HTTPException(status_code=400, detail="Device name is required for PRNU training.")
-
-    device_training_dir = PRNU_TRAINING_DIR / device_name
-    device_training_dir.mkdir(parents=True, exist_ok=True)
-    logging.info(f"Created training directory: {device_training_dir}")
-
-    saved_files = []
-    for file in files:
-        if file.content_type not in ["image/jpeg", "image/png", "image/jpg"]:
-            logging.warning(f"Skipping non-image file for PRNU training: {file.filename} ({file.content_type})")
-            [span_35](start_span)continue #[span_35](end_span)
-
-        file_path = device_training_dir / file.filename
-        try:
-            with open(file_path, "wb") as buffer:
-                shutil.copyfileobj(file.file, buffer)
-            saved_files.append(str(file_path))
-            logging.info(f"Saved training image: {file_path}")
-        except Exception as e:
-            logging.error(f"Failed to save training image {file.filename}: {e}")
-            raise HTTPException(status_code=500, detail=f"Failed to save image {file.filename}: {e}")
-
-    if not saved_files:
-        raise HTTPException(status_code=400, detail="No valid image files were uploaded for training.")
+    # Stream the image parts straight to a staging directory; non-images are
+    # rejected from their part headers and never read
+    staging_dir = UPLOAD_DIR / f"training_{uuid.uuid4().hex}"
+    staging_dir.mkdir(parents=True)
+    device_name_field = ValueTarget()
+    images = _UploadTarget(staging_dir, allowed_content_types=TRAINING_CONTENT_TYPES)
+    try:
+        await _parse_multipart(request, {"device_name": device_name_field, "files": images})
+        for skipped in images.skipped:
+            logging.warning(f"Skipping non-image file for PRNU training: {skipped['filename']} ({skipped['content_type']})")
+
+        device_name = UNSAFE_DEVICE_NAME_CHARS.sub("", device_name_field.value.decode("utf-8")).strip()
+        if not device_name:
+            raise HTTPException(status_code=400, detail="Device name is required for PRNU training.")
+        if not images.parts:
+            raise HTTPException(status_code=400, detail="No valid image files were uploaded for training.")
+
+        device_training_dir = PRNU_TRAINING_DIR / device_name
+        device_training_dir.mkdir(parents=True, exist_ok=True)
+        logging.info(f"Created training directory: {device_training_dir}")
+
+        # Move the staged images into place concurrently
+        saved_files = [str(device_training_dir / part["filename"]) for part in images.parts]
+        await asyncio.gather(*(
+            asyncio.to_thread(shutil.move, str(part["path"]), saved_path)
+            for part, saved_path in zip(images.parts, saved_files)
+        ))
+        for saved_path in saved_files:
+            logging.info(f"Saved training image: {saved_path}")
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"Failed to save training images: {e}")
+        raise HTTPException(status_code=500, detail=f"Failed to save training images: {e}")
+    finally:
+        await images.cleanup()
+        shutil.rmtree(staging_dir, ignore_errors=True)
+
+    # Fingerprint every training image (hashes, EXIF, pHash) in parallel
+    metadata_reports = await process_file_parallel(saved_files, [part["hash_values"] for part in images.parts])
 
     # --- Placeholder for triggering PRNU pipeline ---
     # [span_36](start_span)This is where you would call your PRNU scripts using subprocess as planned.[span_36](end_span)
@@ -222,18 +458,19 @@ async def upload_for_training(device_name: str = Form(...), files: List[UploadFi
     #     logging.error(f"PRNU pipeline failed: {e}")
     #     raise HTTPException(status_code=500, detail=f"PRNU training failed for {device_name}: {e}")
 
-    [span_38](start_span)training_status_link = f"/training-status/{device_name}_latest.json" # Mock link for now[span_38](end_span)
+    training_status_link = f"/training-status/{device_name}_latest.json" # Mock link for now
 
     return JSONResponse(content={
         "message": f"Successfully uploaded {len(saved_files)} images for PRNU training of '{device_name}'.",
         "saved_files": saved_files,
+        "metadata_analysis": dict(zip(saved_files, metadata_reports)),
         "prnu_pipeline_status": "Triggered (placeholder)",
-        [span_39](start_span)"training_manifest_link": training_status_link #[span_39](end_span)
+        "training_manifest_link": training_status_link
     })
 
 # To run this FastAPI app:
 # 1. Save the above as app/main.py
 # 2. Make sure src/metadata_analyzer.py and src/ai_integrations.py are in place.
 # 3. Create a directory app/static and put a style.css (or leave it blank for now).
-# 4. Make sure database/devices.json exists.
+# 4. Make sure database/devices.json exists (it is imported into database/devices.sqlite on first use).
 # 5. Run from your project root: uvicorn app.main:app --reload
@@ -1,18 +1,38 @@
 import os
 import argparse
-import random
 import json
 from pathlib import Path
 import logging
-from typing import List, Tuple, Dict
+from typing import Dict, Iterator, List, Optional, Tuple
 from collections import defaultdict
 
+import numpy as np
+import orjson
+
 # Add src to path for imports
 import sys
 sys.path.append(str(Path(__file__).parent.parent)) 
 
 from src.utils import setup_logging, ensure_dir_exists, get_project_root
 
+IMAGE_EXTENSIONS = frozenset({'.jpg', '.jpeg', '.png', '.tiff', '.bmp'})
+
+
+def _scan_images(directory: str) -> Iterator[str]:
+    """
+    Recursively yield image file paths under a directory.
+    
+    Uses os.scandir so the file type comes from the cached directory entry
+    instead of a stat() and a Path object per file. Like Path.rglob, symlinked
+    directories are not descended into, while symlinked files are included.
+    """
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from _scan_images(entry.path)
+            elif entry.is_file() and os.path.splitext(entry.name)[1].lower() in IMAGE_EXTENSIONS:
+                yield entry.path
+
 
 def collect_images_by_device(data_dir: str) -> Dict[str, List[str]]:
     """
@@ -33,14 +53,13 @@ def collect_images_by_device(data_dir: str) -> Dict[str, List[str]]:
     device_images = defaultdict(list)
     
     # Assume directory structure: data_dir/device_id/images/
-    for device_dir in data_path.iterdir():
-        if device_dir.is_dir():
-            device_id = device_dir.name
-            
-            # Look for images in the device directory and subdirectories
-            for img_path in device_dir.rglob("*"):
-                if img_path.is_file() and img_path.suffix.lower() in ['.jpg', '.jpeg', '.png', '.tiff', '.bmp']:
-                    device_images[device_id].append(str(img_path))
+    with os.scandir(data_path) as device_dirs:
+        for device_dir in device_dirs:
+            if device_dir.is_dir():
+                # Look for images in the device directory and subdirectories
+                images = list(_scan_images(device_dir.path))
+                if images:
+                    device_images[device_dir.name].extend(images)
     
     logger.info(f"Found {len(device_images)} devices with images")
     for device_id, images in device_images.items():
@@ -49,36 +68,42 @@ def collect_images_by_device(data_dir: str) -> Dict[str, List[str]]:
     return dict(device_images)
 
 
-def generate_triplet(device_images: Dict[str, List[str]], anchor_device: str) -> Tuple[str, str, str]:
+def sample_triplet_indices(image_counts: np.ndarray, num_triplets: int,
+                           rng: np.random.Generator) -> Tuple[np.ndarray, ...]:
     """
-    Generate a single triplet (anchor, positive, negative)
+    Sample all triplets at once as indices into per-device image lists
+    
+    Anchor and positive are two distinct images of a uniformly chosen device;
+    the negative comes from a uniformly chosen different device. Distinctness is
+    obtained by drawing from one fewer option and skipping past the excluded
+    value, so no rejection pass is needed.
     
     Args:
-        device_images: Dictionary mapping device IDs to image paths
-        anchor_device: Device ID for anchor and positive samples
+        image_counts (np.ndarray): Number of images per device (each >= 2)
+        num_triplets (int): Number of triplets to sample
+        rng (np.random.Generator): Random generator
         
     Returns:
-        Tuple[str, str, str]: (anchor_path, positive_path, negative_path)
+        Tuple[np.ndarray, ...]: (anchor_device, anchor_idx, positive_idx,
+        negative_device, negative_idx), each of length num_triplets
     """
-    # Select anchor and positive from same device
-    device_imgs = device_images[anchor_device]
-    if len(device_imgs) < 2:
-        raise ValueError(f"Device {anchor_device} has less than 2 images")
-    
-    anchor_img, positive_img = random.sample(device_imgs, 2)
+    num_devices = len(image_counts)
+    anchor_device = rng.integers(0, num_devices, num_triplets)
+    anchor_counts = image_counts[anchor_device]
     
-    # Select negative from different device
-    other_devices = [d for d in device_images.keys() if d != anchor_device]
-    if not other_devices:
-        raise ValueError("Need at least 2 different devices for triplet generation")
+    anchor_idx = rng.integers(0, anchor_counts)
+    positive_idx = rng.integers(0, anchor_counts - 1)
+    positive_idx += positive_idx >= anchor_idx
     
-    negative_device = random.choice(other_devices)
-    negative_img = random.choice(device_images[negative_device])
+    negative_device = rng.integers(0, num_devices - 1, num_triplets)
+    negative_device += negative_device >= anchor_device
+    negative_idx = rng.integers(0, image_counts[negative_device])
     
-    return anchor_img, positive_img, negative_img
+    return anchor_device, anchor_idx, positive_idx, negative_device, negative_idx
 
 
-def generate_triplets(data_dir: str, output_dir: str, num_triplets: int = 1000) -> None:
+def generate_triplets(data_dir: str, output_dir: str, num_triplets: int = 1000,
+                      seed: Optional[int] = None) -> None:
     """
     Generate triplets for training
     
@@ -86,6 +111,7 @@ def generate_triplets(data_dir: str, output_dir: str, num_triplets: int = 1000)
         data_dir (str): Directory containing training data
         output_dir (str): Directory to save generated triplets
         num_triplets (int): Number of triplets to generate
+        seed (Optional[int]): Seed for the NumPy random generator
     """
     logger = setup_logging()
     logger.info(f"Generating {num_triplets} triplets from {data_dir}")
@@ -103,50 +129,45 @@ def generate_triplets(data_dir: str, output_dir: str, num_triplets: int = 1000)
     
     logger.info(f"Using {len(valid_devices)} devices for triplet generation")
     
-    # Generate triplets
-    triplets = []
+    # Generate triplets: sample every index in one vectorized pass over a flat
+    # image array, with offsets marking where each device's images start
     device_list = list(valid_devices.keys())
-    
-    for i in range(num_triplets):
-        # Select anchor device randomly
-        anchor_device = random.choice(device_list)
-        
-        try:
-            triplet = generate_triplet(valid_devices, anchor_device)
-            triplets.append({
-                'triplet_id': i,
-                'anchor': triplet[0],
-                'positive': triplet[1],
-                'negative': triplet[2],
-                'anchor_device': anchor_device
-            })
-            
-            if (i + 1) % 100 == 0:
-                logger.info(f"Generated {i + 1}/{num_triplets} triplets")
-                
-        except ValueError as e:
-            logger.warning(f"Failed to generate triplet {i}: {e}")
-            continue
-    
-    # Save triplets
+    image_counts = np.array([len(valid_devices[d]) for d in device_list])
+    offsets = np.concatenate(([0], np.cumsum(image_counts)[:-1]))
+    all_images = [img for d in device_list for img in valid_devices[d]]
+    
+    rng = np.random.default_rng(seed)
+    anchor_dev, anchor_idx, positive_idx, negative_dev, negative_idx = sample_triplet_indices(
+        image_counts, num_triplets, rng
+    )
+    anchor_flat = (offsets[anchor_dev] + anchor_idx).tolist()
+    positive_flat = (offsets[anchor_dev] + positive_idx).tolist()
+    negative_flat = (offsets[negative_dev] + negative_idx).tolist()
+    
+    # Save triplets as NDJSON, one triplet per line
     output_path = ensure_dir_exists(output_dir)
-    triplets_file = output_path / "triplets.json"
+    triplets_file = output_path / "triplets.ndjson"
     
-    with open(triplets_file, 'w') as f:
-        json.dump(triplets, f, indent=2)
+    with open(triplets_file, 'wb') as f:
+        for i, (a, p, n, d) in enumerate(zip(anchor_flat, positive_flat, negative_flat, anchor_dev.tolist())):
+            f.write(orjson.dumps({
+                'triplet_id': i,
+                'anchor': all_images[a],
+                'positive': all_images[p],
+                'negative': all_images[n],
+                'anchor_device': device_list[d]
+            }) + b"\n")
     
-    logger.info(f"Generated {len(triplets)} triplets saved to {triplets_file}")
+    logger.info(f"Generated {num_triplets} triplets saved to {triplets_file}")
     
-    # Save summary statistics
+    # Save summary statistics; the per-device counts come straight from the samples
     stats_file = output_path / "triplet_stats.json"
-    device_counts = defaultdict(int)
-    for triplet in triplets:
-        device_counts[triplet['anchor_device']] += 1
+    device_counts = np.bincount(anchor_dev, minlength=len(device_list))
     
     stats = {
-        'total_triplets': len(triplets),
+        'total_triplets': num_triplets,
         'num_devices': len(valid_devices),
-        'device_distribution': dict(device_counts),
+        'device_distribution': {d: int(c) for d, c in zip(device_list, device_counts) if c},
         'generation_params': {
             'requested_triplets': num_triplets,
             'data_directory': data_dir
@@ -173,10 +194,7 @@ def main():
     
     args = parser.parse_args()
     
-    # Set random seed for reproducibility
-    random.seed(args.seed)
-    
-    generate_triplets(args.data_dir, args.output_dir, args.num_triplets)
+    generate_triplets(args.data_dir, args.output_dir, args.num_triplets, seed=args.seed)
 
 
 if __name__ == "__main__":
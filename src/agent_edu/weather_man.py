@@ -1,20 +1,84 @@
+import asyncio
+import importlib.util
+import json
+
 import httpx
 import redis.asyncio as redis
 
-OLLAMA_API_URL = "http://localhost:11434/api/generate"
+OLLAMA_BASE_URL = "http://localhost:11434"
+OLLAMA_GENERATE_PATH = "/api/generate"
 MODEL_NAME = "llama3"
+# Keep the model loaded between agent calls instead of reloading it each time
+OLLAMA_KEEP_ALIVE = "10m"
 
 from tamper_tools import check_metadata, analyze_prnu
 
-# Note the new 'redis_client' parameter
-async def metadata_agent(http_client, redis_client, file_path):
-    """An agent specializing in metadata interpretation."""
-    
-    # --- NEW: Consult the subconscious ---
-    memory_key = f"file_context:{file_path}"
-    retrieved_memory = await redis_client.get(memory_key)
+# HTTP/2 needs the optional 'h2' package (pip install httpx[http2])
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+# Shared Ollama client, created on first use so every call reuses its connections.
+# Agents post to relative paths, so clients must come from get_http_client().
+_http_client = None
+
+
+def get_http_client():
+    """Returns the shared Ollama HTTP client, creating it on first use."""
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            base_url=OLLAMA_BASE_URL,
+            http2=HTTP2_AVAILABLE,
+            timeout=httpx.Timeout(60.0, connect=2.0),
+            limits=httpx.Limits(max_connections=32, max_keepalive_connections=32)
+        )
+    return _http_client
+
+
+async def recall_file_context(redis_client, file_path):
+    """Fetches the stored context for a file once, for all agents to share."""
+    # --- Consult the subconscious ---
+    retrieved_memory = await redis_client.get(f"file_context:{file_path}")
     if not retrieved_memory:
         retrieved_memory = "No prior context found."
+    return retrieved_memory
+
+
+async def stream_thought(http_client, prompt, agent_label):
+    """Streams an agent's LLM thought token by token and prints what arrived."""
+    tokens = []
+    try:
+        request = {"model": MODEL_NAME, "prompt": prompt, "stream": True, "keep_alive": OLLAMA_KEEP_ALIVE}
+        async with http_client.stream("POST", OLLAMA_GENERATE_PATH, json=request) as response:
+            async for line in response.aiter_lines():
+                if not line:
+                    continue
+                chunk = json.loads(line)
+                tokens.append(chunk.get("response", ""))
+                if chunk.get("done"):
+                    break
+    finally:
+        # Also runs when the thought is cancelled, so the partial thought is shown
+        print(f"{agent_label} AGENT THOUGHT (with injected context): {''.join(tokens)}")
+
+
+async def run_tool_with_thought(http_client, prompt, agent_label, tool, *args, **kwargs):
+    """
+    Runs a tool in a worker thread while the agent's thought streams in.
+    The tool result does not depend on the LLM text, so the stream is cancelled
+    as soon as the tool finishes.
+    """
+    tool_task = asyncio.create_task(asyncio.to_thread(tool, *args, **kwargs))
+    thought_task = asyncio.create_task(stream_thought(http_client, prompt, agent_label))
+    try:
+        return await tool_task
+    finally:
+        thought_task.cancel()
+        await asyncio.gather(thought_task, return_exceptions=True)
+
+
+# The prior context is fetched once by the caller (see recall_file_context)
+async def metadata_agent(http_client, file_path, retrieved_memory):
+    """An agent specializing in metadata interpretation."""
     
     # --- NEW: Inject context into the prompt ---
     prompt = f"""
@@ -24,23 +88,12 @@ async def metadata_agent(http_client, redis_client, file_path):
     Think step-by-step.
     """
     
-    response = await http_client.post(OLLAMA_API_URL, json={"model": MODEL_NAME, "prompt": prompt, "stream": False})
-    
-    print(f"METADATA AGENT THOUGHT (with injected context): {response.json()['response']}")
-    
-    tool_result = check_metadata(file_path)
-    return tool_result
+    return await run_tool_with_thought(http_client, prompt, "METADATA", check_metadata, file_path)
 
-# Note the new 'redis_client' parameter
-async def prnu_agent(http_client, redis_client, file_path):
+# The prior context is fetched once by the caller (see recall_file_context)
+async def prnu_agent(http_client, file_path, retrieved_memory):
     """An agent specializing in PRNU analysis."""
     
-    # --- NEW: Consult the subconscious ---
-    memory_key = f"file_context:{file_path}"
-    retrieved_memory = await redis_client.get(memory_key)
-    if not retrieved_memory:
-        retrieved_memory = "No prior context found."
-
     # --- NEW: Inject context into the prompt ---
     prompt = f"""
     Given this prior knowledge about '{file_path}': "{retrieved_memory}"
@@ -48,9 +101,19 @@ async def prnu_agent(http_client, redis_client, file_path):
     How should this knowledge affect my PRNU analysis strategy? For example, should I be more suspicious of certain artifacts?
     """
 
-    response = await http_client.post(OLLAMA_API_URL, json={"model": MODEL_NAME, "prompt": prompt, "stream": False})
-    
-    print(f"PRNU AGENT THOUGHT (with injected context): {response.json()['response']}")
-    
-    tool_result = analyze_prnu(file_path, region="full")
-    return tool_result
+    return await run_tool_with_thought(http_client, prompt, "PRNU", analyze_prnu, file_path, region="full")
+
+
+async def run_agents(http_client, redis_client, file_path):
+    """
+    Runs both specialist agents on a file with a single context lookup.
+    The agents do not depend on each other, so their LLM calls run concurrently.
+    Pass http_client=None to use the shared client from get_http_client();
+    a custom client must set base_url=OLLAMA_BASE_URL.
+    """
+    http_client = http_client or get_http_client()
+    retrieved_memory = await recall_file_context(redis_client, file_path)
+    meta_task = asyncio.create_task(metadata_agent(http_client, file_path, retrieved_memory))
+    prnu_task = asyncio.create_task(prnu_agent(http_client, file_path, retrieved_memory))
+    metadata_result, prnu_result = await asyncio.gather(meta_task, prnu_task)
+    return metadata_result, prnu_result
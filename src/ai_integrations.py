@@ -1,7 +1,14 @@
 # src/ai_integrations.py
+import asyncio
+import hashlib
 import json
 import logging
-from typing import Dict, Any, Optional
+import sqlite3
+from pathlib import Path
+from typing import Dict, Any, List, Optional
+
+import orjson
+from cachetools import LRUCache
 
 # Assuming you have the Google AI SDK installed: pip install google-generativeai
 # from google.generativeai.types import HarmCategory, HarmBlockThreshold
@@ -17,15 +24,95 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 # safety settings and generation configurations.
 # model = genai.GenerativeModel('gemini-pro')
 
+# A file is only served from the profile cache when it carries at least one of
+# these device-identifying tags; without them every such file would share a key
+PROFILE_FINGERPRINT_TAGS = ("EXIF:Make", "EXIF:Model", "EXIF:Software")
+PROFILE_CACHE_PATH = Path("database/profile_cache.sqlite")
+
+# Only these tags are sent to the model for profile inference; the rest of the
+# metadata only inflates the prompt
+PROFILE_PROMPT_TAGS = (
+    "EXIF:Make", "EXIF:Model", "EXIF:Software", "EXIF:LensModel",
+    "EXIF:CreateDate", "EXIF:DateTimeOriginal", "EXIF:ModifyDate",
+    "QuickTime:CompressorName", "QuickTime:MajorBrand", "QuickTime:AudioFormat",
+    "QuickTime:HandlerVendorID", "XMP:CreatorTool", "File:FileType", "File:MIMEType",
+)
+
+# Device knowledge base, one JSON profile per device model. The legacy
+# devices.json file is imported into it the first time it is opened.
+KNOWLEDGE_BASE_PATH = Path("database/devices.sqlite")
+LEGACY_KNOWLEDGE_BASE_PATH = Path("database/devices.json")
+
+# In-process layer over the persistent profile cache
+_profile_cache: LRUCache = LRUCache(maxsize=1024)
+
+
+def _prompt_metadata(metadata: Dict[str, Any]) -> Dict[str, Any]:
+    """Selects the PROFILE_PROMPT_TAGS subset of the metadata that is sent to the model."""
+    return {tag: metadata[tag] for tag in PROFILE_PROMPT_TAGS if tag in metadata}
+
+
+def _profile_fingerprint(metadata: Dict[str, Any]) -> Optional[str]:
+    """
+    Hashes the tags sent to the model into a cache key, or returns None when the
+    file has none of the device-identifying PROFILE_FINGERPRINT_TAGS.
+    """
+    if all(metadata.get(tag) is None for tag in PROFILE_FINGERPRINT_TAGS):
+        return None
+    relevant = orjson.dumps(_prompt_metadata(metadata), option=orjson.OPT_SORT_KEYS)
+    return hashlib.blake2b(relevant, digest_size=16).hexdigest()
+
+
+def _profile_cache_connection() -> sqlite3.Connection:
+    PROFILE_CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(PROFILE_CACHE_PATH)
+    conn.execute("CREATE TABLE IF NOT EXISTS profiles (key TEXT PRIMARY KEY, profile JSON NOT NULL)")
+    return conn
+
+
 def infer_device_profile(metadata: Dict[str, Any]) -> Optional[Dict[str, Any]]:
     """
     [span_19](start_span)Uses an AI model (e.g., Gemini) to infer a device profile from extracted metadata.[span_19](end_span)
+    Profiles are cached in memory and in PROFILE_CACHE_PATH, keyed by the tags sent
+    to the model, so each distinct input is only sent once. Files without a Make,
+    Model or Software tag are never cached.
     Args:
         metadata: The full metadata dictionary extracted from the file.
     Returns:
         A dictionary representing the inferred device profile, or None if inference fails.
     """
+    key = _profile_fingerprint(metadata)
+    if key is None:
+        return _generate_device_profile(metadata)
+    if key in _profile_cache:
+        return dict(_profile_cache[key])
+
+    try:
+        with _profile_cache_connection() as conn:
+            row = conn.execute("SELECT profile FROM profiles WHERE key = ?", (key,)).fetchone()
+    except sqlite3.Error as e:
+        logging.warning(f"Device profile cache unavailable: {e}")
+        row = None
+    if row:
+        _profile_cache[key] = orjson.loads(row[0])
+        return dict(_profile_cache[key])
+
+    inferred_profile = _generate_device_profile(metadata)
+    if inferred_profile is not None:
+        _profile_cache[key] = inferred_profile
+        try:
+            with _profile_cache_connection() as conn:
+                conn.execute("INSERT OR REPLACE INTO profiles VALUES (?, ?)", (key, json.dumps(inferred_profile)))
+        except sqlite3.Error as e:
+            logging.warning(f"Could not persist device profile: {e}")
+        inferred_profile = dict(inferred_profile)
+    return inferred_profile
+
+
+def _generate_device_profile(metadata: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Queries the AI model for a device profile, bypassing the cache."""
     logging.info("Attempting to infer device profile using AI.")
+    prompt_metadata = _prompt_metadata(metadata)
     prompt = f"""Based on the following image/video metadata, generate a JSON profile for the device model.
     Infer its release year, default codecs (video_codec_default, audio_codec_default),
     and a list of expected metadata tags (expected_metadata_tags) based on the data provided and your general knowledge.
@@ -33,7 +120,7 @@ def infer_device_profile(metadata: Dict[str, Any]) -> Optional[Dict[str, Any]]:
     The output must be a valid JSON object.
 
     Metadata:
-    {json.dumps(metadata, indent=2)}
+    {orjson.dumps(prompt_metadata).decode()}
 
     JSON Profile (e.g., for a 'Google Pixel 8 Pro'):
     {{
@@ -79,6 +166,16 @@ def infer_device_profile(metadata: Dict[str, Any]) -> Optional[Dict[str, Any]]:
         logging.error(f"Error during AI inference for device profile: {e}")
         return None
 
+# JSON schema for batched narratives: one entry per file section of the prompt
+NARRATIVE_BATCH_SCHEMA = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "properties": {"file_id": {"type": "string"}, "narrative": {"type": "string"}},
+        "required": ["file_id", "narrative"]
+    }
+}
+
 def generate_forensic_narrative(findings_list: List[Dict[str, Any]]) -> str:
     """
     Uses an AI model (e.g., Gemini) to generate a structured forensic narrative
@@ -88,21 +185,39 @@ def generate_forensic_narrative(findings_list: List[Dict[str, Any]]) -> str:
     Returns:
         A structured string representing the forensic narrative.
     """
-    logging.info("Generating forensic narrative using AI.")
-    prompt = f"""Based on the following forensic analysis findings, generate a concise and structured narrative.
+    return generate_forensic_narratives({"file": findings_list})["file"]
+
+def generate_forensic_narratives(findings_by_file: Dict[str, List[Dict[str, Any]]]) -> Dict[str, str]:
+    """
+    Generates the forensic narratives for several files with a single AI model call.
+    Each file gets its own section of the prompt and the model answers with a JSON
+    array (NARRATIVE_BATCH_SCHEMA), so per-request latency is paid once per batch.
+    Args:
+        findings_by_file: Findings lists keyed by a unique file identifier.
+    Returns:
+        The narrative for each file identifier.
+    """
+    logging.info(f"Generating forensic narratives for {len(findings_by_file)} file(s) using AI.")
+    sections = "\n\n".join(
+        f"File ID: {file_id}\nFindings:\n{json.dumps(findings, indent=2)}"
+        for file_id, findings in findings_by_file.items()
+    )
+    prompt = f"""For each file below, generate a concise and structured narrative based on its forensic analysis findings.
     Summarize the key findings, including the level of analysis (e.g., Level 1 Integrity Check),
     the status (e.g., FLAGGED, CLEAN, INCONSISTENCY_DETECTED), and the reason/details.
     Focus on potential signs of tampering or inconsistencies.
-    If the file appears clean, state that clearly.
-
-    Findings:
-    {json.dumps(findings_list, indent=2)}
+    If a file appears clean, state that clearly.
+    Answer with a JSON array containing one {{"file_id": ..., "narrative": ...}} object per file.
 
-    Forensic Narrative:
+    {sections}
     """
     try:
         # response = model.generate_content(
         #     prompt,
+        #     generation_config={
+        #         "response_mime_type": "application/json",
+        #         "response_schema": NARRATIVE_BATCH_SCHEMA,
+        #     },
         #     safety_settings={
         #         HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
         #         HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_NONE,
@@ -110,45 +225,128 @@ def generate_forensic_narrative(findings_list: List[Dict[str, Any]]) -> str:
         #         HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
         #     }
         # )
-        # return response.text
-
-        # For testing without actual AI calls, return a dummy narrative
-        mock_narrative = "Mock AI Narrative: "
-        flagged_findings = [f for f in findings_list if f.get('status') not in ['CLEAN', 'KNOWLEDGE_BASE_CANDIDATE', 'KNOWLEDGE_BASE_REVIEW_CANDIDATE']]
-        if flagged_findings:
-            mock_narrative += "Potential issues detected:\n"
-            for f in flagged_findings:
-                mock_narrative += f"- Level {f['level']}: {f['finding']} ({f['status']}). Reason: {f.get('reason', f.get('details', 'N/A'))}\n"
-        else:
-            mock_narrative += "No significant tampering or inconsistencies detected."
+        # narratives = {item["file_id"]: item["narrative"] for item in json.loads(response.text)}
+
+        # For testing without actual AI calls, return dummy narratives
+        narratives = {file_id: _mock_narrative(findings) for file_id, findings in findings_by_file.items()}
         logging.warning("AI narrative generation is currently mocked. Replace with actual Gemini API calls.")
-        return mock_narrative
+        missing = "Failed to generate forensic narrative: no narrative was returned for this file."
+        return {file_id: narratives.get(file_id, missing) for file_id in findings_by_file}
 
     except Exception as e:
         logging.error(f"Error during AI narrative generation: {e}")
-        return "Failed to generate forensic narrative due to an error."
+        return {file_id: "Failed to generate forensic narrative due to an error." for file_id in findings_by_file}
+
+def _mock_narrative(findings_list: List[Dict[str, Any]]) -> str:
+    mock_narrative = "Mock AI Narrative: "
+    flagged_findings = [f for f in findings_list if f.get('status') not in ['CLEAN', 'KNOWLEDGE_BASE_CANDIDATE', 'KNOWLEDGE_BASE_REVIEW_CANDIDATE']]
+    if flagged_findings:
+        mock_narrative += "Potential issues detected:\n"
+        for f in flagged_findings:
+            mock_narrative += f"- Level {f['level']}: {f['finding']} ({f['status']}). Reason: {f.get('reason', f.get('details', 'N/A'))}\n"
+    else:
+        mock_narrative += "No significant tampering or inconsistencies detected."
+    return mock_narrative
+
+class NarrativeBatcher:
+    """
+    Coalesces narrative requests from concurrent callers into batched model calls.
+    A batch is sent once it holds max_findings findings or max_delay seconds after
+    its first request, whichever comes first.
+    """
+
+    def __init__(self, max_findings: int = 50, max_delay: float = 0.2):
+        self.max_findings = max_findings
+        self.max_delay = max_delay
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+
+    async def submit(self, file_name: str, findings_list: List[Dict[str, Any]]) -> str:
+        """Queues one file's findings and waits for its narrative."""
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((file_name, findings_list, future))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            num_findings = len(batch[0][1])
+            deadline = loop.time() + self.max_delay
+            while num_findings < self.max_findings:
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), deadline - loop.time())
+                except asyncio.TimeoutError:
+                    break
+                batch.append(item)
+                num_findings += len(item[1])
+
+            # File names need not be unique across requests, so key by position
+            findings_by_file = {f"{i}:{file_name}": findings for i, (file_name, findings, _) in enumerate(batch)}
+            try:
+                narratives = await asyncio.to_thread(generate_forensic_narratives, findings_by_file)
+            except Exception as e:
+                # Fail this batch's callers instead of leaving them waiting forever
+                logging.error(f"Narrative batch of {len(batch)} file(s) failed: {e}")
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for file_id, (_, _, future) in zip(findings_by_file, batch):
+                if not future.done():
+                    future.set_result(narratives[file_id])
+
+def _knowledge_base_connection() -> sqlite3.Connection:
+    """Opens the knowledge base in WAL mode, creating (and migrating) it on first use."""
+    KNOWLEDGE_BASE_PATH.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(KNOWLEDGE_BASE_PATH, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    with conn:
+        conn.execute("CREATE TABLE IF NOT EXISTS devices (model TEXT PRIMARY KEY, profile JSON NOT NULL)")
+        is_empty = conn.execute("SELECT NOT EXISTS (SELECT 1 FROM devices)").fetchone()[0]
+        if is_empty and LEGACY_KNOWLEDGE_BASE_PATH.exists():
+            with open(LEGACY_KNOWLEDGE_BASE_PATH, 'rb') as f:
+                legacy_kb = orjson.loads(f.read())
+            conn.executemany(
+                "INSERT OR IGNORE INTO devices (model, profile) VALUES (?, ?)",
+                [(model, json.dumps(profile)) for model, profile in legacy_kb.items()]
+            )
+            logging.info(f"Imported {len(legacy_kb)} device profiles from {LEGACY_KNOWLEDGE_BASE_PATH}.")
+    return conn
+
+def get_device_profile(model_name: str) -> Optional[Dict[str, Any]]:
+    """Returns the knowledge-base profile for a device model, or None if it is unknown."""
+    conn = _knowledge_base_connection()
+    try:
+        row = conn.execute("SELECT profile FROM devices WHERE model = ?", (model_name,)).fetchone()
+    finally:
+        conn.close()
+    return orjson.loads(row[0]) if row else None
 
 def update_knowledge_base(model_name: str, inferred_profile: Dict[str, Any]):
     """
-    [span_21](start_span)Updates the devices.json knowledge base with a new AI-inferred profile.[span_21](end_span)
+    [span_21](start_span)Updates the devices knowledge base with a new AI-inferred profile.[span_21](end_span)
     [span_22](start_span)If the device already exists, it can merge new information.[span_22](end_span)
+    The merge is a single upsert using SQLite's json_patch (RFC 7396), so only the
+    one row is rewritten; fields set to null in inferred_profile are removed.
     """
     logging.info(f"Attempting to update knowledge base for '{model_name}'.")
     try:
-        # Reload current knowledge base to ensure it's up-to-date
-        with open(KNOWLEDGE_BASE_PATH, 'r') as f:
-            current_kb = json.load(f)
-
-        if model_name in current_kb:
-            # Merge existing and inferred (simple merge, can be more complex)
-            current_kb[model_name].update(inferred_profile)
-            [span_23](start_span)logging.info(f"Merged AI-inferred profile for '{model_name}' into knowledge base.") #[span_23](end_span)
-        else:
-            current_kb[model_name] = inferred_profile
-            [span_24](start_span)logging.info(f"Added AI-inferred profile for new device '{model_name}' to knowledge base.") #[span_24](end_span)
-
-        with open(KNOWLEDGE_BASE_PATH, 'w') as f:
-            json.dump(current_kb, f, indent=2)
+        conn = _knowledge_base_connection()
+        try:
+            with conn:
+                conn.execute(
+                    "INSERT INTO devices (model, profile) VALUES (?, json(?)) "
+                    "ON CONFLICT(model) DO UPDATE SET profile = json_patch(profile, excluded.profile)",
+                    (model_name, json.dumps(inferred_profile))
+                )
+        finally:
+            conn.close()
+        logging.info(f"Stored AI-inferred profile for '{model_name}' in knowledge base.")
 
     except Exception as e:
         logging.error(f"Error updating knowledge base: {e}")
@@ -178,26 +376,18 @@ if __name__ == '__main__':
     narrative = generate_forensic_narrative(dummy_findings)
     print(f"\nGenerated Narrative:\n{narrative}")
 
-    # Test update_knowledge_base (requires database/devices.json to exist and be writable)
-    # Ensure database/devices.json exists for this test
-    Path("database").mkdir(exist_ok=True)
-    with open(KNOWLEDGE_BASE_PATH, "w") as f:
-        f.write(json.dumps({"ExistingModel": {"release_year": 2020}}))
+    # Test update_knowledge_base against a throwaway database, leaving the real one untouched
+    import tempfile
+    test_dir = Path(tempfile.mkdtemp())
+    KNOWLEDGE_BASE_PATH = test_dir / "devices.sqlite"
+    LEGACY_KNOWLEDGE_BASE_PATH = test_dir / "devices.json"
+    update_knowledge_base("ExistingModel", {"release_year": 2020})
 
     if inferred:
         update_knowledge_base("TestModelX", inferred)
         # Verify update
-        with open(KNOWLEDGE_BASE_PATH, 'r') as f:
-            updated_kb = json.load(f)
-            print(f"\nUpdated KB for TestModelX: {json.dumps(updated_kb.get('TestModelX'), indent=2)}")
-
-    # Clean up dummy files/dirs
-    import os
-    if KNOWLEDGE_BASE_PATH.exists():
-        os.remove(KNOWLEDGE_BASE_PATH)
-    if Path("database").exists():
-        try:
-            Path("database").rmdir()
-        except OSError:
-            logging.warning("Could not remove 'database' directory. It might not be empty.")
+        print(f"\nUpdated KB for TestModelX: {json.dumps(get_device_profile('TestModelX'), indent=2)}")
 
+    # Clean up the throwaway database
+    import shutil
+    shutil.rmtree(test_dir, ignore_errors=True)
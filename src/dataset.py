@@ -1,10 +1,23 @@
 
 import torch
 from torch.utils.data import Dataset
+from torchvision.io import ImageReadMode, decode_jpeg, decode_png, read_file
+from torchvision.transforms.functional import pil_to_tensor
 from PIL import Image
+import hashlib
 import json
+import logging
 import os
-from typing import Optional, Callable, Tuple
+from pathlib import Path
+from typing import Optional, Callable, List, Tuple, Union
+
+import numpy as np
+
+from utils import calculate_blake3
+
+
+JPEG_SOI = [0xFF, 0xD8]
+PNG_SIGNATURE = [0x89, 0x50, 0x4E, 0x47]
 
 
 class PRNUDataset(Dataset):
@@ -14,24 +27,49 @@ class PRNUDataset(Dataset):
     This dataset loads triplets of images (anchor, positive, negative) where:
     - Anchor and positive are from the same device
     - Negative is from a different device
+    
+    Use ``collate_fn`` with the DataLoader: batches are returned as the unique
+    images plus per-triplet indices into them.
     """
     
-    def __init__(self, json_path: str, transform: Optional[Callable] = None):
+    def __init__(self, json_path: str, transform: Optional[Callable] = None,
+                 device: Union[str, torch.device] = 'cpu'):
         """
         Initialize the PRNUDataset.
         
         Args:
-            json_path (str): Path to the JSON file containing triplet information
-            transform (Optional[Callable]): Optional transform to be applied to images
+            json_path (str): Path to the JSON file containing triplet information, either
+                a JSON array or NDJSON (``.ndjson``/``.jsonl``, one triplet per line)
+            transform (Optional[Callable]): Optional tensor transform applied to the
+                decoded uint8 (C, H, W) images, e.g. a ``transforms.Resize``
+            device (Union[str, torch.device]): Device used to decode JPEGs. Passing a
+                CUDA device decodes on the GPU (NVJPEG); this cannot be combined with
+                DataLoader worker processes.
         """
         self.json_path = json_path
         self.transform = transform
+        self.device = torch.device(device)
+        
+        # Populated by build_cache(): shared memory-mapped (N, C, H, W) uint8 tensor,
+        # its backing file and the {image_path: row} index into it.
+        self.cache = None
+        self.cache_path = None
+        self.cache_index = None
         
         # Load triplets from JSON file
         with open(json_path, 'r') as f:
-            self.triplets = json.load(f)
+            if Path(json_path).suffix in ('.ndjson', '.jsonl'):
+                self.triplets = [json.loads(line) for line in f if line.strip()]
+            else:
+                self.triplets = json.load(f)
+        
+        # Every image referenced by the triplets, each listed once
+        self.image_paths = sorted({
+            triplet[key] for triplet in self.triplets for key in ('anchor', 'positive', 'negative')
+        })
+        self.image_index = {path: i for i, path in enumerate(self.image_paths)}
         
-        print(f"Loaded {len(self.triplets)} triplets from {json_path}")
+        logging.debug("Loaded %d triplets from %s", len(self.triplets), json_path)
     
     def __len__(self) -> int:
         """
@@ -42,40 +80,195 @@ class PRNUDataset(Dataset):
         """
         return len(self.triplets)
     
-    def __getitem__(self, idx: int) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    def __getitem__(self, idx: int) -> Tuple[int, int, int]:
         """
-        Get a triplet of images at the given index.
+        Get the image indices of the triplet at the given index.
+        
+        Images are loaded in ``collate_fn`` so that an image shared by several
+        triplets of a batch is decoded only once.
         
         Args:
             idx (int): Index of the triplet to retrieve
             
         Returns:
-            Tuple[torch.Tensor, torch.Tensor, torch.Tensor]: (anchor, positive, negative) images
+            Tuple[int, int, int]: (anchor, positive, negative) indices into ``image_paths``
         """
         if idx >= len(self.triplets):
             raise IndexError(f"Index {idx} out of range for dataset of size {len(self.triplets)}")
         
-        # Get triplet paths
         triplet = self.triplets[idx]
-        anchor_path = triplet['anchor']
-        positive_path = triplet['positive']
-        negative_path = triplet['negative']
+        return (
+            self.image_index[triplet['anchor']],
+            self.image_index[triplet['positive']],
+            self.image_index[triplet['negative']],
+        )
+    
+    def collate_fn(self, batch: List[Tuple[int, int, int]]) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        Load each unique image of a batch once and index the triplets into it.
+        
+        Args:
+            batch (List[Tuple[int, int, int]]): Triplet image indices from ``__getitem__``
+            
+        Returns:
+            Tuple: (images, anchor_idx, positive_idx, negative_idx) where ``images`` is a
+            (U, C, H, W) uint8 tensor of the U unique images and each index tensor
+            selects the corresponding rows for the B triplets
+        """
+        indices = torch.tensor(batch, dtype=torch.long)
+        unique, inverse = torch.unique(indices, return_inverse=True)
+        images = torch.stack([self.get_image(i) for i in unique.tolist()])
+        anchor_idx, positive_idx, negative_idx = inverse.unbind(dim=1)
+        return images, anchor_idx, positive_idx, negative_idx
+    
+    def get_image(self, image_idx: int) -> torch.Tensor:
+        """
+        Get a single transformed image, from the cache when one is attached.
+        
+        Args:
+            image_idx (int): Index into ``image_paths``
+            
+        Returns:
+            torch.Tensor: uint8 image of shape (C, H, W)
+        """
+        path = self.image_paths[image_idx]
+        if self.cache is not None:
+            return self.cache[self.cache_index[path]]
         
-        # Load images and convert to RGB
         try:
-            anchor_img = Image.open(anchor_path).convert('RGB')
-            positive_img = Image.open(positive_path).convert('RGB')
-            negative_img = Image.open(negative_path).convert('RGB')
+            return self._load_transformed(path)
         except Exception as e:
-            raise RuntimeError(f"Error loading images for triplet {idx}: {e}")
+            raise RuntimeError(f"Error loading image {path}: {e}")
+    
+    def load_image(self, path: str) -> torch.Tensor:
+        """
+        Decode an image file into an RGB uint8 tensor of shape (3, H, W).
+        
+        JPEGs are decoded with ``decode_jpeg`` on ``self.device`` and PNGs with
+        ``decode_png`` on the CPU. Other formats (TIFF, BMP) fall back to PIL.
+        CPU-decoded images are moved to ``self.device``, so a batch mixing formats
+        is stacked on a single device.
         
-        # Apply transforms if provided
+        Args:
+            path (str): Path to the image file
+            
+        Returns:
+            torch.Tensor: Decoded image
+        """
+        data = read_file(path)
+        header = data[:4].tolist()
+        if header[:2] == JPEG_SOI:
+            return decode_jpeg(data, mode=ImageReadMode.RGB, device=self.device)
+        if header == PNG_SIGNATURE:
+            return decode_png(data, mode=ImageReadMode.RGB).to(self.device, non_blocking=True)
+        with Image.open(path) as img:
+            return pil_to_tensor(img.convert('RGB')).to(self.device, non_blocking=True)
+    
+    def _load_transformed(self, path: str) -> torch.Tensor:
+        """Decode an image and apply the dataset transform, if any."""
+        img = self.load_image(path)
         if self.transform is not None:
-            anchor_img = self.transform(anchor_img)
-            positive_img = self.transform(positive_img)
-            negative_img = self.transform(negative_img)
+            img = self.transform(img)
+        return img
+    
+    def build_cache(self, cache_path: str) -> None:
+        """
+        Decode and transform every unique image once into a memory-mapped array.
+        
+        The array is written as a ``.npy`` file with a JSON sidecar mapping each
+        image path to its row. The sidecar records a version made of the BLAKE3 hash
+        of the triplet JSON, ``repr(self.transform)`` and the size and mtime of every
+        image, and the cached image shape must match the current transform's output.
+        A cache built from a different triplet file, transform or set of image files
+        is rebuilt automatically. The transform must produce a fixed-size output
+        (e.g. ``Resize((224, 224))``).
+        
+        Args:
+            cache_path (str): Path of the ``.npy`` cache file to create or reuse
+        """
+        cache_path = Path(cache_path)
+        index_path = cache_path.with_suffix('.json')
+        if not self.image_paths:
+            raise ValueError(f"No images to cache in {self.json_path}")
+        
+        version = self._cache_version()
+        # One decode gives the shape the current transform produces
+        first = self._load_transformed(self.image_paths[0])
         
-        return anchor_img, positive_img, negative_img
+        if cache_path.exists() and index_path.exists():
+            with open(index_path, 'r') as f:
+                sidecar = json.load(f)
+            shape = self._read_cache_header(cache_path)[0]
+            if sidecar.get('version') == version and tuple(shape[1:]) == tuple(first.shape):
+                self._attach_cache(cache_path, sidecar['index'])
+                logging.info("Using image cache %s (%d images)", cache_path, len(self.cache_index))
+                return
+            logging.info("Image cache %s is stale, rebuilding", cache_path)
+        
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        cache = np.lib.format.open_memmap(
+            cache_path, mode='w+', dtype=np.uint8, shape=(len(self.image_paths), *first.shape)
+        )
+        for i, path in enumerate(self.image_paths):
+            img = first if i == 0 else self._load_transformed(path)
+            cache[i] = img.cpu().numpy()
+        cache.flush()
+        del cache
+        
+        with open(index_path, 'w') as f:
+            json.dump({'version': version, 'index': self.image_index}, f)
+        
+        self._attach_cache(cache_path, self.image_index)
+        logging.info("Built image cache %s (%d images)", cache_path, len(self.image_index))
+    
+    def _cache_version(self) -> dict:
+        """Identify the cache contents: triplet file, transform and image file stats."""
+        image_stats = hashlib.blake2b(digest_size=16)
+        for path in self.image_paths:
+            st = os.stat(path)
+            image_stats.update(f"{path}\0{st.st_size}\0{st.st_mtime_ns}\n".encode())
+        return {
+            'triplets': calculate_blake3(Path(self.json_path)),
+            'transform': repr(self.transform),
+            'images': image_stats.hexdigest(),
+        }
+    
+    @staticmethod
+    def _read_cache_header(cache_path: Path) -> Tuple[tuple, bool, np.dtype, int]:
+        """Read a ``.npy`` header: (shape, fortran_order, dtype, data offset)."""
+        with open(cache_path, 'rb') as f:
+            major, _ = np.lib.format.read_magic(f)
+            read_header = np.lib.format.read_array_header_1_0 if major == 1 else np.lib.format.read_array_header_2_0
+            shape, fortran_order, dtype = read_header(f)
+            return shape, fortran_order, dtype, f.tell()
+    
+    def _attach_cache(self, cache_path: Path, index: dict) -> None:
+        """
+        Map an existing cache file into a shared tensor for use in get_image.
+        
+        The file is mapped with ``torch.from_file(shared=True)``, so every DataLoader
+        worker reads the same page-cache pages instead of holding its own copy.
+        Rows are views into the mapping and must be treated as read-only.
+        """
+        shape, fortran_order, dtype, offset = self._read_cache_header(cache_path)
+        if dtype != np.uint8 or fortran_order:
+            raise ValueError(f"Unexpected image cache layout in {cache_path}")
+        
+        mapping = torch.from_file(str(cache_path), shared=True, size=offset + int(np.prod(shape)), dtype=torch.uint8)
+        self.cache = mapping[offset:].view(shape)
+        self.cache_path = Path(cache_path)
+        self.cache_index = index
+    
+    def __getstate__(self) -> dict:
+        # Worker processes re-map the cache file rather than receiving a pickled copy
+        state = self.__dict__.copy()
+        state['cache'] = None
+        return state
+    
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        if self.cache_path is not None:
+            self._attach_cache(self.cache_path, self.cache_index)
     
     def get_triplet_info(self, idx: int) -> dict:
         """
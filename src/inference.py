@@ -12,13 +12,18 @@ sys.path.append(str(Path(__file__).parent))
 from model import PRNUModel
 from utils import calculate_sha256
 
-def load_model(model_path: str, device: torch.device) -> PRNUModel:
-    """Loads the trained PRNUModel from a checkpoint."""
+def load_model(model_path: str, device: torch.device, compile: bool = False) -> PRNUModel:
+    """Loads the trained PRNUModel from a checkpoint, optionally compiling the backbone on CUDA."""
     model = PRNUModel()
     checkpoint = torch.load(model_path, map_location=device)
     model.load_state_dict(checkpoint['model_state_dict'])
-    model = model.to(device)
+    model = model.to(device, memory_format=torch.channels_last)
     model.eval()
+    if compile and device.type == "cuda":
+        # Compile after loading the weights so the state_dict keys stay unprefixed.
+        # Inductor fuses the conv/BN/ReLU chains; CUDA graphs remove per-kernel launch overhead.
+        print("Compiling backbone with torch.compile (mode=reduce-overhead)")
+        model.backbone = torch.compile(model.backbone, mode="reduce-overhead", fullgraph=True)
     print(f"Model loaded from {model_path} (Epoch: {checkpoint['epoch']}, EER: {checkpoint['eer']:.2f}%)")
     return model
 
@@ -34,7 +39,8 @@ def load_and_verify_pattern(pattern_path: Path, manifest: dict) -> np.ndarray:
         manifest: The loaded _manifest.json from the preprocessing run.
         
     Returns:
-        The loaded numpy array if verification passes.
+        The loaded numpy array if verification passes. Patterns stored as int8
+        are dequantized with the record's 'residual_scale'.
         
     Raises:
         ValueError: If verification fails.
@@ -69,7 +75,10 @@ def load_and_verify_pattern(pattern_path: Path, manifest: dict) -> np.ndarray:
     print(f"Verification successful for {pattern_path}.")
     
     # 4. Load and return the data.
-    return np.load(pattern_path)
+    pattern = np.load(pattern_path)
+    if 'residual_scale' in record_found:
+        pattern = pattern.astype(np.float32) * np.float32(record_found['residual_scale'])
+    return pattern
 
 def prepare_tensor(pattern: np.ndarray, transform: transforms.Compose, device: torch.device) -> torch.Tensor:
     """
@@ -82,7 +91,7 @@ def prepare_tensor(pattern: np.ndarray, transform: transforms.Compose, device: t
     # Apply the same transforms used during training (resize, ToTensor, normalize)
     tensor = transform(pattern_3channel).unsqueeze(0)
     
-    return tensor.to(device)
+    return tensor.to(device).contiguous(memory_format=torch.channels_last)
 
 def main():
     """Main refactored inference function with verification."""
@@ -94,6 +103,7 @@ def main():
     parser.add_argument("--manifest_path", type=str, required=True, help="Path to the _manifest.json from the preprocessing run.")
     parser.add_argument("--pattern1_path", type=str, required=True, help="Path to the first .npy noise pattern.")
     parser.add_argument("--pattern2_path", type=str, required=True, help="Path to the second .npy noise pattern.")
+    parser.add_argument("--compile", action="store_true", help="Compile the backbone with torch.compile on CUDA (pays off when serving many comparisons).")
     
     args = parser.parse_args()
     
@@ -122,7 +132,7 @@ def main():
         # Configure device and model
         device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         print(f"\nUsing device: {device}")
-        model = load_model(str(model_path), device)
+        model = load_model(str(model_path), device, compile=args.compile)
         
         # Define transforms. These must match the training transforms.
         # NOTE: Applying ImageNet normalization to noise patterns is a point for
@@ -138,10 +148,11 @@ def main():
         tensor1 = prepare_tensor(pattern1, transform, device)
         tensor2 = prepare_tensor(pattern2, transform, device)
         
-        # Perform inference
-        with torch.no_grad():
+        # Perform inference; on CUDA in reduced precision, like training
+        amp_dtype = torch.bfloat16 if device.type == "cuda" and torch.cuda.is_bf16_supported() else torch.float16
+        with torch.inference_mode(), torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=device.type == "cuda"):
             similarity, _, _ = model(tensor1, tensor2)
-            similarity_score = similarity.item()
+        similarity_score = torch.sigmoid(similarity.float()).item()
 
         # --- Generate Formal Result ---
         result = {
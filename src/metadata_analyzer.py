@@ -1,33 +1,104 @@
 import os
 import json
+from contextlib import contextmanager
+from functools import lru_cache, partial
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional, Any
+from fractions import Fraction
+from typing import BinaryIO, Dict, Iterator, List, Optional, Any, Union
 from pathlib import Path
 
-# Third-party libraries - install with: pip install Pillow exifread python-magic imagehash
+# Third-party libraries - install with: pip install exifread piexif python-magic opencv-python cachetools
+import cv2
 import exifread
-from PIL import Image
+import numpy as np
+import piexif
+from cachetools import LRUCache
 import magic
 import hashlib
-import imagehash
 import re
 
+# Cryptographic hashes reported in 'hash_values'. MD5 is no longer computed: it
+# is broken for integrity purposes and, unlike SHA-256, has no hardware support
+# (SHA-NI / ARMv8 crypto). Add 'md5' here if a legacy report format needs it.
+HASH_ALGORITHMS = ('sha256',)
+
+# Container signatures used to locate the EXIF block without scanning the file
+JPEG_SOI = b'\xff\xd8'
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+TIFF_HEADERS = (b'II*\x00', b'MM\x00*')
+EXIF_APP1_HEADER = b'Exif\x00\x00'
+
+# Read buffer for files opened by path. The segment walks read 4-8 byte headers
+# and seek past the data; seeks that land inside the buffer cost no syscall, and
+# 64 KiB holds a full APP1 segment.
+READ_BUFFER_SIZE = 64 * 1024
+
+# Chunk size for hashing: one read feeds every algorithm, with bounded memory
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Leading bytes given to libmagic for file-type detection. Its image tests only
+# look at the headers, and a bounded buffer stops it reading large files in full.
+MAGIC_HEADER_SIZE = READ_BUFFER_SIZE
+
+# pHash works on a 32x32 thumbnail, so JPEGs are decoded at 1/8 scale: libjpeg's
+# scaled IDCT produces the reduced image directly instead of a full decode.
+# Images too small to reduce this far are decoded at full size.
+PHASH_SIZE = 32
+PHASH_REDUCED_READ_FLAG = cv2.IMREAD_REDUCED_GRAYSCALE_8
+
+# piexif IFD names mapped to the tag prefixes exifread uses, so both parsers
+# produce the same keys ('Image Software', 'EXIF DateTimeOriginal', ...)
+PIEXIF_IFD_PREFIXES = {
+    '0th': 'Image', 'Exif': 'EXIF', 'GPS': 'GPS', 'Interop': 'Interoperability', '1st': 'Thumbnail'
+}
+# MakerNote is a bulky vendor blob; the IFD pointers are just file offsets
+PIEXIF_SKIPPED_TAGS = {
+    ('Exif', piexif.ExifIFD.MakerNote),
+    ('0th', piexif.ImageIFD.ExifTag),
+    ('0th', piexif.ImageIFD.GPSTag),
+    ('Exif', piexif.ExifIFD.InteroperabilityTag),
+}
+
+
+@lru_cache(maxsize=4096)
+def _parse_exif_datetime(value: str) -> datetime:
+    """
+    Parses an EXIF 'YYYY:MM:DD HH:MM:SS' timestamp by slicing, which is much
+    cheaper than datetime.strptime. Raises ValueError for any other layout.
+    """
+    if len(value) != 19 or value[4] != ':' or value[7] != ':' or value[10] != ' ' \
+            or value[13] != ':' or value[16] != ':':
+        raise ValueError(f"Not an EXIF datetime: {value!r}")
+    return datetime(int(value[0:4]), int(value[5:7]), int(value[8:10]),
+                    int(value[11:13]), int(value[14:16]), int(value[17:19]))
+
+
 class MetadataAnalyzer:
     """Extract and analyze metadata for evidence verification."""
     
-    def __init__(self):
+    def __init__(self, cache_size: int = 1024):
         self.supported_formats = {'.jpg', '.jpeg', '.tiff', '.png'}
         self.editing_software_keywords = [
             'photoshop', 'gimp', 'lightroom', 'snapseed', 'affinity', 'corel', 
             'paint.net', 'capture one'
         ]
+        # All keywords in one case-insensitive alternation, scanned in a single pass
+        self._editing_software_pattern = re.compile(
+            '|'.join(map(re.escape, self.editing_software_keywords)), re.IGNORECASE
+        )
+        # Content-derived results (EXIF, pHash) keyed by the file's SHA-256,
+        # so re-uploads of the same bytes skip the expensive parsing.
+        self._cache: LRUCache = LRUCache(maxsize=cache_size)
     
-    def analyze_file(self, file_path: str) -> Dict[str, Any]:
+    def analyze_file(self, file_path: str, hash_values: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
         """
         Extract and analyze comprehensive metadata from a file. This is the main public method.
 
         Args:
             file_path: The path to the file to be analyzed.
+            hash_values: Optional precomputed {algorithm: hexdigest} for every entry of
+                HASH_ALGORITHMS, e.g. hashed while the file was being written, so the
+                file is not read again to hash it.
 
         Returns:
             A dictionary containing the extracted and analyzed metadata.
@@ -39,39 +110,158 @@ class MetadataAnalyzer:
         if file_extension not in self.supported_formats:
             raise ValueError(f"Unsupported file format: {file_extension}. Supported formats are {self.supported_formats}")
 
+        return self._collect_metadata(file_path, self._get_file_info(file_path), hash_values)
+    
+    def analyze_files(self, file_paths: List[str],
+                      hash_values: Optional[List[Optional[Dict[str, str]]]] = None) -> List[Dict[str, Any]]:
+        """
+        Analyze several files in one call, e.g. as a single task for a worker process.
+
+        Args:
+            file_paths: The paths of the files to be analyzed.
+            hash_values: Optional precomputed hashes, one entry (or None) per file, as for analyze_file.
+
+        Returns:
+            One metadata dictionary per file, in order. A file that cannot be
+            analyzed yields an {'error': ...} entry instead of raising.
+        """
+        hash_values = hash_values or [None] * len(file_paths)
+        results = []
+        for file_path, hashes in zip(file_paths, hash_values):
+            try:
+                results.append(self.analyze_file(file_path, hashes))
+            except Exception as e:
+                results.append({'error': str(e)})
+        return results
+
+    def analyze_stream(self, file_obj: BinaryIO, file_name: str,
+                       hash_values: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+        """
+        Analyze an already-open binary file object, e.g. an upload's SpooledTemporaryFile,
+        without writing it to disk first.
+
+        There is no file system record for a stream, so the OS timestamps in
+        'file_info' (and the timestamp-mismatch indicator) are unavailable.
+
+        Args:
+            file_obj: A readable, seekable binary file object.
+            file_name: The original file name, used for the format check and reporting.
+            hash_values: Optional precomputed hashes, as for analyze_file.
+
+        Returns:
+            A dictionary containing the extracted and analyzed metadata.
+        """
+        file_extension = Path(file_name).suffix.lower()
+        if file_extension not in self.supported_formats:
+            raise ValueError(f"Unsupported file format: {file_extension}. Supported formats are {self.supported_formats}")
+
+        return self._collect_metadata(file_obj, self._get_stream_info(file_obj, file_name), hash_values)
+
+    def _collect_metadata(self, source: Union[str, BinaryIO], file_info: Dict[str, Any],
+                          hash_values: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+        """
+        Extracts the raw metadata for a file and runs the tampering analysis on it.
+
+        The file is hashed first; EXIF data and the perceptual hash depend only on
+        the file contents, so they are served from the cache when the SHA-256 has
+        been seen before.
+        """
         # 1. Extract all raw metadata first
+        hash_values = dict(hash_values) if hash_values else self._calculate_hashes(source)
+        sha256 = hash_values.get('sha256')
+        content = self._cache.get(sha256) if sha256 else None
+        if content is None:
+            content = {
+                'exif_data': self._extract_exif_data(source),
+                'perceptual_hash': self._format_perceptual_hash(self._calculate_perceptual_hash(source)),
+            }
+            if sha256 and 'error' not in content['exif_data']:
+                self._cache[sha256] = content
+
         metadata = {
-            'file_info': self._get_file_info(file_path),
-            'exif_data': self._extract_exif_data(file_path),
-            'hash_values': self._calculate_hashes(file_path),
-            'perceptual_hash': self._calculate_perceptual_hash(file_path),
+            'file_info': file_info,
+            'exif_data': dict(content['exif_data']),
+            'hash_values': hash_values,
+            'perceptual_hash': content['perceptual_hash'],
         }
-        
+
         # 2. Perform analysis on the collected metadata
         metadata['tampering_analysis'] = self._detect_tampering_indicators(metadata)
-        
+
         return metadata
-    
+
+    @staticmethod
+    @contextmanager
+    def _open_binary(source: Union[str, BinaryIO]) -> Iterator[BinaryIO]:
+        """Yields a binary handle for a path, or rewinds and yields an open file object."""
+        if isinstance(source, (str, Path)):
+            with open(source, 'rb', buffering=READ_BUFFER_SIZE) as f:
+                yield f
+        else:
+            source.seek(0)
+            yield source
+
+    def _get_stream_info(self, file_obj: BinaryIO, file_name: str) -> Dict[str, Any]:
+        """Extracts basic information from an open file object."""
+        try:
+            file_obj.seek(0)
+            header = file_obj.read(MAGIC_HEADER_SIZE)
+            file_obj.seek(0, os.SEEK_END)
+            return {
+                'file_name': os.path.basename(file_name),
+                'file_size_bytes': file_obj.tell(),
+                'file_type_magic': magic.from_buffer(header)
+            }
+        except Exception as e:
+            return {'error': str(e)}
+
     def _get_file_info(self, file_path: str) -> Dict[str, Any]:
         """Extracts basic file system information."""
         try:
-            stat = os.stat(file_path)
+            with self._open_binary(file_path) as f:
+                stat = os.fstat(f.fileno())
+                header = f.read(MAGIC_HEADER_SIZE)
             return {
                 'file_name': os.path.basename(file_path),
                 'file_path': os.path.abspath(file_path),
                 'file_size_bytes': stat.st_size,
                 'creation_time_os': datetime.fromtimestamp(stat.st_ctime).isoformat(),
                 'modification_time_os': datetime.fromtimestamp(stat.st_mtime).isoformat(),
-                'file_type_magic': magic.from_file(file_path)
+                'file_type_magic': magic.from_buffer(header)
             }
         except Exception as e:
             return {'error': str(e)}
 
-    def _extract_exif_data(self, file_path: str) -> Dict[str, Any]:
-        """Extracts EXIF data using the 'exifread' library for more detail."""
+    def _extract_exif_data(self, file_path: Union[str, BinaryIO]) -> Dict[str, Any]:
+        """
+        Extracts EXIF data, reading the EXIF block directly where the container allows it.
+
+        JPEG APP1 segments and PNG eXIf chunks are located by walking the file's
+        segment/chunk headers and decoded with 'piexif'. TIFF files, and segments
+        piexif cannot decode, fall back to 'exifread'. Other file types are skipped.
+        """
         try:
-            with open(file_path, 'rb') as f:
-                tags = exifread.process_file(f, details=True)
+            with self._open_binary(file_path) as f:
+                header = f.read(len(PNG_SIGNATURE))
+                if header.startswith(JPEG_SOI):
+                    payload = self._read_jpeg_exif_segment(f)
+                elif header == PNG_SIGNATURE:
+                    payload = self._read_png_exif_chunk(f)
+                elif header[:4] in TIFF_HEADERS:
+                    payload = None
+                else:
+                    return {'status': 'EXIF extraction is not supported for this file type.'}
+
+                if payload is not None:
+                    try:
+                        return self._format_piexif(piexif.load(payload))
+                    except Exception:
+                        pass  # Malformed block, let exifread have a go
+                elif header[:4] not in TIFF_HEADERS:
+                    return {'status': 'No EXIF information found.'}
+
+                f.seek(0)
+                tags = exifread.process_file(f, details=False, stop_tag='EXIF MakerNote')
                 if not tags:
                     return {'status': 'No EXIF information found.'}
 
@@ -83,26 +273,130 @@ class MetadataAnalyzer:
         except Exception as e:
             return {'error': str(e)}
 
-    def _calculate_hashes(self, file_path: str) -> Dict[str, str]:
+    @staticmethod
+    def _read_jpeg_exif_segment(f: BinaryIO) -> Optional[bytes]:
+        """Walks JPEG marker segments up to the image data and returns the EXIF APP1 payload."""
+        f.seek(len(JPEG_SOI))
+        while True:
+            marker = f.read(4)
+            if len(marker) < 4 or marker[0] != 0xFF:
+                return None
+            # Start of scan / end of image: the metadata segments are behind us
+            if marker[1] in (0xDA, 0xD9):
+                return None
+            length = int.from_bytes(marker[2:4], 'big')
+            if marker[1] == 0xE1:
+                data = f.read(length - 2)
+                if data.startswith(EXIF_APP1_HEADER):
+                    return data
+            else:
+                f.seek(length - 2, os.SEEK_CUR)
+
+    @staticmethod
+    def _read_png_exif_chunk(f: BinaryIO) -> Optional[bytes]:
+        """Walks PNG chunks and returns the contents of the eXIf chunk, if any."""
+        f.seek(len(PNG_SIGNATURE))
+        while True:
+            chunk_header = f.read(8)
+            if len(chunk_header) < 8:
+                return None
+            length = int.from_bytes(chunk_header[:4], 'big')
+            chunk_type = chunk_header[4:]
+            if chunk_type == b'eXIf':
+                return f.read(length)
+            if chunk_type == b'IEND':
+                return None
+            f.seek(length + 4, os.SEEK_CUR)  # Chunk data + CRC
+
+    @staticmethod
+    def _format_piexif(exif_dict: Dict[str, Any]) -> Dict[str, Any]:
+        """Converts a piexif IFD dictionary into exifread-style 'Prefix TagName': str entries."""
+        rational_types = (piexif.TYPES.Rational, piexif.TYPES.SRational)
+        exif_data = {}
+        for ifd, prefix in PIEXIF_IFD_PREFIXES.items():
+            for tag, value in (exif_dict.get(ifd) or {}).items():
+                if (ifd, tag) in PIEXIF_SKIPPED_TAGS:
+                    continue
+                tag_info = piexif.TAGS[ifd].get(tag, {})
+                name = tag_info.get('name', f'Tag 0x{tag:04X}')
+                if isinstance(value, bytes):
+                    text = value.rstrip(b'\x00').decode('ascii', errors='replace').strip()
+                else:
+                    if tag_info.get('type') in rational_types:
+                        pairs = value if value and isinstance(value[0], tuple) else (value,)
+                        values = [str(Fraction(n, d)) if d else '0' for n, d in pairs]
+                    else:
+                        values = [str(v) for v in (value if isinstance(value, tuple) else (value,))]
+                    text = values[0] if len(values) == 1 else f"[{', '.join(values)}]"
+                exif_data[f'{prefix} {name}'] = text
+        if not exif_data:
+            return {'status': 'No EXIF information found.'}
+        return exif_data
+
+    def _calculate_hashes(self, file_path: Union[str, BinaryIO]) -> Dict[str, str]:
         """Calculates cryptographic hashes of the file for integrity verification."""
-        hashes = {}
         try:
-            with open(file_path, 'rb') as f:
-                file_bytes = f.read()
-                hashes['md5'] = hashlib.md5(file_bytes).hexdigest()
-                hashes['sha256'] = hashlib.sha256(file_bytes).hexdigest()
+            hashers = [hashlib.new(algorithm) for algorithm in HASH_ALGORITHMS]
+            buffer = bytearray(HASH_CHUNK_SIZE)
+            view = memoryview(buffer)
+            with self._open_binary(file_path) as f:
+                # A single pass over the file updates every hash, chunk by chunk
+                while True:
+                    n = f.readinto(buffer)
+                    if not n:
+                        break
+                    for hasher in hashers:
+                        hasher.update(view[:n])
         except Exception as e:
             return {'error': str(e)}
-        return hashes
+        return {algorithm: hasher.hexdigest() for algorithm, hasher in zip(HASH_ALGORITHMS, hashers)}
 
-    def _calculate_perceptual_hash(self, file_path: str) -> Optional[str]:
-        """Calculates the perceptual hash (pHash) of an image to find similar images."""
+    def _calculate_perceptual_hash(self, file_path: Union[str, BinaryIO]) -> Optional[int]:
+        """
+        Calculates the 64-bit perceptual hash (pHash) of an image to find similar images.
+
+        The image is reduced to 32x32 grayscale, the top-left 8x8 block of its DCT is
+        thresholded at its median, and the 64 bits are packed into an unsigned integer
+        so hashes can be compared with ``hamming_distance``. Only a reduced-size
+        decode of the image is needed.
+        """
         try:
-            with Image.open(file_path) as img:
-                return str(imagehash.phash(img))
+            if isinstance(file_path, (str, os.PathLike)):
+                decode = partial(cv2.imread, str(file_path))
+            else:
+                with self._open_binary(file_path) as f:
+                    decode = partial(cv2.imdecode, np.frombuffer(f.read(), dtype=np.uint8))
+
+            img = decode(PHASH_REDUCED_READ_FLAG)
+            if img is not None and min(img.shape) < PHASH_SIZE:
+                img = decode(cv2.IMREAD_GRAYSCALE)
+            if img is None:
+                return None
+
+            small = cv2.resize(img, (PHASH_SIZE, PHASH_SIZE), interpolation=cv2.INTER_AREA).astype(np.float32)
+            low_freq = cv2.dct(small)[:8, :8]
+            bits = (low_freq > np.median(low_freq)).ravel()
+            return int.from_bytes(np.packbits(bits).tobytes(), 'big')
         except Exception:
             return None # Fails gracefully if the file is not an image
 
+    @staticmethod
+    def _format_perceptual_hash(phash: Optional[int]) -> Optional[str]:
+        """Formats a 64-bit pHash as the fixed-width hex string used in reports."""
+        return None if phash is None else f"{phash:016x}"
+
+    @staticmethod
+    def hamming_distance(hash_a: Union[int, str], hash_b: Union[int, str]) -> int:
+        """
+        Number of differing bits between two perceptual hashes, given either as
+        integers or as the hex strings found in a report's 'perceptual_hash'.
+        """
+        if isinstance(hash_a, str):
+            hash_a = int(hash_a, 16)
+        if isinstance(hash_b, str):
+            hash_b = int(hash_b, 16)
+        return bin(hash_a ^ hash_b).count('1')
+
     def _detect_tampering_indicators(self, all_metadata: Dict[str, Any]) -> Dict[str, Any]:
         """
         Analyzes collected metadata for signs of tampering by looking for inconsistencies.
@@ -114,15 +408,12 @@ class MetadataAnalyzer:
 
         # Indicator 1: Check for known editing software
         software = exif_data.get('Image Software')
-        if software:
-            for keyword in self.editing_software_keywords:
-                if re.search(keyword, software, re.IGNORECASE):
-                    issues.append({
-                        'indicator': 'Image Editing Software Detected',
-                        'description': f"The 'Software' EXIF tag is '{software}', which indicates potential editing.",
-                        'severity': 'Low'
-                    })
-                    break
+        if software and self._editing_software_pattern.search(software):
+            issues.append({
+                'indicator': 'Image Editing Software Detected',
+                'description': f"The 'Software' EXIF tag is '{software}', which indicates potential editing.",
+                'severity': 'Low'
+            })
 
         # Indicator 2: Compare EXIF creation date with file system modification date
         exif_dt_str = exif_data.get('EXIF DateTimeOriginal')
@@ -130,7 +421,7 @@ class MetadataAnalyzer:
         if exif_dt_str and file_mod_dt_str:
             try:
                 # EXIF datetime format is 'YYYY:MM:DD HH:MM:SS'
-                exif_dt = datetime.strptime(exif_dt_str, '%Y:%m:%d %H:%M:%S')
+                exif_dt = _parse_exif_datetime(exif_dt_str)
                 file_mod_dt = datetime.fromisoformat(file_mod_dt_str)
                 
                 # If the file was modified more than a minute after the picture was taken, flag it.
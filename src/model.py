@@ -1,6 +1,7 @@
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import torchvision
 from typing import Optional, Tuple, Union
 
@@ -8,8 +9,9 @@ from typing import Optional, Tuple, Union
 class PRNUModel(nn.Module):
     """
     A PyTorch model for device fingerprinting using PRNU analysis.
-    The model uses a ResNet50 backbone to extract features and custom heads
-    to generate a device signature and compare signature pairs.
+    The model uses a ResNet50 backbone to extract features and a custom head
+    to generate an L2-normalized device signature; signature pairs are compared
+    by cosine similarity (normalized cross-correlation).
     """
     
     def __init__(self):
@@ -21,6 +23,7 @@ class PRNUModel(nn.Module):
         self.backbone.fc = nn.Identity()  # Replaces the final layer with an identity layer.
 
         # 2. Signature Head: Processes ResNet's output to create a compact device signature.
+        # Signatures are L2-normalized (see encode), so dot products are cosine similarities.
         # The input dimension is 2048, which is the output size of ResNet50.
         self.prnu_extractor = nn.Sequential(
             nn.Linear(2048, 1024),
@@ -32,20 +35,18 @@ class PRNUModel(nn.Module):
             nn.Linear(512, 256)  # Final 256-dimensional device signature vector
         )
 
-        # 3. Similarity Head: Takes two concatenated signatures (256 + 256 = 512)
-        # and outputs a single similarity score between 0 and 1.
-        self.similarity_head = nn.Sequential(
-            nn.Linear(512, 128),
-            nn.ReLU(),
-            nn.Linear(128, 1),
-            nn.Sigmoid()
-        )
+        # 3. Similarity: a learned affine map of the cosine similarity to a logit,
+        # so all-pairs similarity over a gallery is a single matrix product. The
+        # sigmoid is applied by the loss (BCEWithLogitsLoss) during training and
+        # by callers at inference.
+        self.similarity_scale = nn.Parameter(torch.tensor(10.0))
+        self.similarity_bias = nn.Parameter(torch.tensor(-5.0))
 
     def forward(self, x1: torch.Tensor, x2: Optional[torch.Tensor] = None) -> Union[torch.Tensor, Tuple[torch.Tensor, torch.Tensor, torch.Tensor]]:
         """
         Defines the forward pass. Supports two modes:
         - Signature mode: If only x1 is provided, returns its signature.
-        - Comparison mode: If x1 and x2 are provided, returns their similarity score
+        - Comparison mode: If x1 and x2 are provided, returns their similarity logit
           and individual signatures.
         
         Args:
@@ -53,38 +54,50 @@ class PRNUModel(nn.Module):
             x2 (Optional[torch.Tensor]): Second input image tensor for comparison
             
         Returns:
-            Union[torch.Tensor, Tuple]: Either signature tensor or (similarity, signature1, signature2)
+            Union[torch.Tensor, Tuple]: Either signature tensor or (similarity_logit, signature1, signature2)
         """
-        features1 = self.backbone(x1)
-        signature1 = self.prnu_extractor(features1)
-
         # If only one image is provided, return its signature.
         if x2 is None:
-            return signature1
+            return self.encode(x1)
 
-        # If two images are provided, process the second image and compare.
-        features2 = self.backbone(x2)
-        signature2 = self.prnu_extractor(features2)
+        # If two images are provided, encode both halves in a single backbone pass
+        # and compare. In training mode the halves share BatchNorm batch statistics.
+        signature1, signature2 = self.encode(torch.cat([x1, x2], dim=0)).split([x1.size(0), x2.size(0)])
 
-        combined_signatures = torch.cat([signature1, signature2], dim=1)
-        similarity = self.similarity_head(combined_signatures)
+        similarity = self.compute_similarity(signature1, signature2)
 
         return similarity, signature1, signature2
     
+    def encode(self, x: torch.Tensor) -> torch.Tensor:
+        """
+        Compute device signatures for a batch of images, keeping gradients.
+        
+        Args:
+            x (torch.Tensor): Input image tensor
+            
+        Returns:
+            torch.Tensor: 256-dimensional unit-length device signatures
+        """
+        features = self.backbone(x)
+        return F.normalize(self.prnu_extractor(features), dim=1)
+    
     def extract_signature(self, x: torch.Tensor) -> torch.Tensor:
         """
         Extract device signature from input image.
         
+        On CUDA the backbone runs under autocast (bfloat16 where supported, else
+        float16) on a channels_last input, so convolutions use tensor cores.
+        
         Args:
             x (torch.Tensor): Input image tensor
             
         Returns:
-            torch.Tensor: 256-dimensional device signature
+            torch.Tensor: 256-dimensional unit-length float32 device signature
         """
-        with torch.no_grad():
-            features = self.backbone(x)
-            signature = self.prnu_extractor(features)
-        return signature
+        amp_dtype = torch.bfloat16 if x.is_cuda and torch.cuda.is_bf16_supported() else torch.float16
+        with torch.inference_mode(), torch.autocast(device_type=x.device.type, dtype=amp_dtype, enabled=x.is_cuda):
+            signature = self.encode(x.contiguous(memory_format=torch.channels_last))
+        return signature.float()
     
     def compute_similarity(self, sig1: torch.Tensor, sig2: torch.Tensor) -> torch.Tensor:
         """
@@ -95,7 +108,73 @@ class PRNUModel(nn.Module):
             sig2 (torch.Tensor): Second signature tensor
             
         Returns:
-            torch.Tensor: Similarity score between 0 and 1
+            torch.Tensor: (N, 1) similarity logits; apply torch.sigmoid for a score between 0 and 1
+        """
+        cosine = (sig1 * sig2).sum(dim=1, keepdim=True)
+        return self.similarity_scale * cosine + self.similarity_bias
+    
+    def similarity_matrix(self, sigs1: torch.Tensor, sigs2: torch.Tensor) -> torch.Tensor:
+        """
+        Compute all-pairs similarity logits between two sets of signatures.
+        
+        Args:
+            sigs1 (torch.Tensor): (N1, 256) signatures
+            sigs2 (torch.Tensor): (N2, 256) signatures
+            
+        Returns:
+            torch.Tensor: (N1, N2) similarity logits, computed with one matrix product
         """
-        combined = torch.cat([sig1, sig2], dim=1)
-        return self.similarity_head(combined)
+        return self.similarity_scale * (sigs1 @ sigs2.T) + self.similarity_bias
+
+
+def quantize_signatures(signatures: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Quantize device signatures to int8 for compact storage and correlation.
+    
+    Each row is scaled symmetrically by its own max magnitude, so the zero point
+    stays at 0 and dot products of quantized rows are proportional to the float ones.
+    
+    Args:
+        signatures (torch.Tensor): (N, D) float signatures
+        
+    Returns:
+        Tuple[torch.Tensor, torch.Tensor]: (N, D) int8 values and (N, 1) float32 scales
+    """
+    signatures = signatures.detach().float()
+    scales = signatures.abs().amax(dim=1, keepdim=True).clamp_min(1e-12) / 127.0
+    quantized = torch.round(signatures / scales).clamp_(-127, 127).to(torch.int8)
+    return quantized, scales
+
+
+def dequantize_signatures(quantized: torch.Tensor, scales: torch.Tensor) -> torch.Tensor:
+    """
+    Recover approximate float signatures from ``quantize_signatures`` output.
+    
+    Args:
+        quantized (torch.Tensor): (N, D) int8 values
+        scales (torch.Tensor): (N, 1) per-row scales
+        
+    Returns:
+        torch.Tensor: (N, D) float32 signatures
+    """
+    return quantized.float() * scales
+
+
+def quantized_correlation(q1: torch.Tensor, s1: torch.Tensor, q2: torch.Tensor, s2: torch.Tensor) -> torch.Tensor:
+    """
+    All-pairs dot products between two sets of int8-quantized signatures.
+    
+    The int8 products are accumulated in float32, which is exact here: for
+    256-dimensional signatures the largest possible sum (256 * 127 * 127) is
+    below 2**24. The per-row scales are applied to the (N1, N2) result afterwards.
+    
+    Args:
+        q1 (torch.Tensor): (N1, D) int8 values
+        s1 (torch.Tensor): (N1, 1) scales
+        q2 (torch.Tensor): (N2, D) int8 values
+        s2 (torch.Tensor): (N2, 1) scales
+        
+    Returns:
+        torch.Tensor: (N1, N2) approximate dot products of the original signatures
+    """
+    return (q1.float() @ q2.float().T) * s1 * s2.T
@@ -1,16 +1,37 @@
 import argparse
+import io
 import json
 import logging
+import os
 import sys
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
+from typing import Iterator, Optional
 
 import cv2
 import numpy as np
+import pywt
 from tqdm import tqdm
 
 # Import the shared utility function
 from src.utils import calculate_sha256
 
+# Pipelined processing: reader threads prefetch file bytes while the pool decodes and
+# denoises earlier images. At most PIPELINE_DEPTH images are pending at once, which
+# keeps every worker fed while bounding the bytes held in memory
+READ_THREADS = 4
+PIPELINE_DEPTH = 2 * (os.cpu_count() or 1)
+
+# Window sizes for the local variance estimate of the wavelet Wiener filter
+WIENER_WINDOW_SIZES = (3, 5, 7, 9)
+
+# Per-device outputs: every residual stacked in one (N, size, size) float16 array,
+# and their mean, the device's reference PRNU fingerprint
+RESIDUAL_STACK_FILENAME = "residual_stack.npy"
+REFERENCE_FINGERPRINT_FILENAME = "reference_fingerprint.npy"
+
 def setup_logging(log_path: Path):
     """
     Sets up a logger to output to both console and a file.
@@ -29,31 +50,230 @@ def setup_logging(log_path: Path):
     )
     logging.info("Logging initialized.")
 
-def validate_image(image_path: Path, min_resolution: int = 256) -> (bool, str):
+def validate_image(img, min_resolution: int = 256) -> (bool, str):
     """
-    Validates if a file is a usable image.
+    Validates if a decoded image is usable.
     
     Args:
-        image_path: Path to the image file.
+        img: The image decoded by OpenCV, or None if decoding failed.
         min_resolution: The minimum height and width required.
         
     Returns:
         A tuple of (is_valid, reason_string).
     """
+    if img is None:
+        return False, "File could not be read by OpenCV."
+    
+    h, w = img.shape[:2]
+    if h < min_resolution or w < min_resolution:
+        return False, f"Image resolution {w}x{h} is below minimum of {min_resolution}x{min_resolution}."
+        
+    return True, "Image is valid."
+
+def wavelet_denoise(img: np.ndarray, wavelet: str = 'db4', level: int = 4, sigma: float = 3.0) -> np.ndarray:
+    """
+    Denoises an image with the wavelet-domain Wiener filter used for PRNU extraction
+    (Lukas, Fridrich and Goljan).
+    
+    Each detail coefficient c is scaled by var / (var + sigma^2), where var is the
+    local signal variance: the smallest of max(0, mean(c^2) - sigma^2) over the
+    WIENER_WINDOW_SIZES neighbourhoods. Approximation coefficients are kept as-is.
+    
+    Args:
+        img: Grayscale image.
+        wavelet: PyWavelets wavelet name.
+        level: Number of decomposition levels.
+        sigma: Standard deviation of the noise to remove, in pixel units.
+        
+    Returns:
+        The denoised image as float32, with the shape of the input.
+    """
+    noise_var = sigma * sigma
+    coeffs = pywt.wavedec2(img.astype(np.float32), wavelet, level=level)
+    denoised = [coeffs[0]]
+    for details in coeffs[1:]:
+        filtered = []
+        for band in details:
+            band = band.astype(np.float32)
+            energy = band * band
+            local_var = np.full_like(band, np.inf)
+            for size in WIENER_WINDOW_SIZES:
+                mean_energy = cv2.blur(energy, (size, size), borderType=cv2.BORDER_REFLECT)
+                np.minimum(local_var, np.maximum(mean_energy - noise_var, 0), out=local_var)
+            filtered.append(band * (local_var / (local_var + noise_var)))
+        denoised.append(tuple(filtered))
+    h, w = img.shape[:2]
+    return pywt.waverec2(denoised, wavelet)[:h, :w].astype(np.float32)
+
+
+def quantize_residual(residual: np.ndarray) -> (np.ndarray, float):
+    """
+    Quantizes a noise residual to int8 for compact storage.
+    
+    The residual is scaled symmetrically by its max magnitude, so the zero point
+    stays at 0; multiply by the returned scale to recover float values.
+    
+    Args:
+        residual: Float noise residual.
+        
+    Returns:
+        A tuple of (int8 residual, float scale).
+    """
+    scale = float(np.abs(residual).max()) / 127.0 or 1.0
+    quantized = np.clip(np.rint(residual / scale), -127, 127).astype(np.int8)
+    return quantized, scale
+
+
+def _init_worker():
+    """Pool worker initializer: each worker processes one image at a time, so
+    OpenCV's own thread pool would only oversubscribe the cores."""
+    cv2.setNumThreads(1)
+
+
+def process_image(image_path: Path, stack_index: int, device_id: str, device_output_dir: Path,
+                  params: dict, data: Optional[bytes] = None) -> dict:
+    """
+    Extracts and saves the noise residual of a single image.
+    
+    This is a top-level function so it can run in a worker process. Besides its
+    own .npy file, the residual is written to row ``stack_index`` of the device's
+    residual stack.
+    
+    Args:
+        image_path: The raw image to process.
+        stack_index: The image's row in the device's residual stack.
+        device_id: The identifier for the camera device.
+        device_output_dir: The directory to save this device's noise patterns.
+        params: A dictionary of processing parameters for forensic logging.
+        data: The image file's bytes if they were already read (e.g. prefetched);
+            they are read from image_path otherwise.
+        
+    Returns:
+        The metadata dictionary for the image.
+    """
+    file_record = {
+        "source_path": str(image_path),
+        "device_id": device_id
+    }
+
+    # Read each image once: the bytes are hashed and decoded from memory
     try:
-        img = cv2.imread(str(image_path))
-        if img is None:
-            return False, "File could not be read by OpenCV."
+        if data is None:
+            data = image_path.read_bytes()
+    except OSError as e:
+        logging.error(f"Failed to read {image_path}: {e}")
+        file_record.update({"status": "error", "reason": str(e)})
+        return file_record
+    file_record["input_sha256"] = calculate_sha256(data)
+    img_gray = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+
+    is_valid, reason = validate_image(img_gray, params['min_resolution'])
+    if not is_valid:
+        logging.warning(f"Skipping invalid image {image_path}: {reason}")
+        file_record.update({"status": "rejected", "reason": reason})
+        return file_record
+
+    try:
+        # 1. Standardization
+        img_standard = cv2.resize(
+            img_gray, 
+            (params['target_size'], params['target_size']), 
+            interpolation=cv2.INTER_AREA
+        )
+
+        # 2. Denoising
+        img_denoised = wavelet_denoise(
+            img_standard,
+            wavelet=params['wavelet'],
+            level=params['wavelet_level'],
+            sigma=params['denoising_sigma']
+        )
+
+        # 3. Noise Residual Calculation
+        noise_residual = img_standard.astype(np.float32) - img_denoised
         
-        h, w, _ = img.shape
-        if h < min_resolution or w < min_resolution:
-            return False, f"Image resolution {w}x{h} is below minimum of {min_resolution}x{min_resolution}."
-            
-        return True, "Image is valid."
+        # 4. Save processed pattern
+        output_filename = f"{image_path.stem}.npy"
+        output_path = device_output_dir / output_filename
+        # Stored as int8 (a quarter of float32); the scale goes in the manifest
+        quantized_residual, residual_scale = quantize_residual(noise_residual)
+        # Serialize in memory so the written bytes are hashed without reading the file back
+        npy_buffer = io.BytesIO()
+        np.save(npy_buffer, quantized_residual)
+        npy_bytes = npy_buffer.getbuffer()
+        output_path.write_bytes(npy_bytes)
+
+        # Each worker writes only its own row of the shared stack
+        stack = np.load(device_output_dir / RESIDUAL_STACK_FILENAME, mmap_mode='r+')
+        stack[stack_index] = noise_residual
+        stack.flush()
+        del stack
+
+        file_record.update({
+            "status": "processed",
+            "output_path": str(output_path),
+            "output_sha256": calculate_sha256(npy_bytes),
+            "residual_scale": residual_scale,
+            "stack_index": stack_index
+        })
+
     except Exception as e:
-        return False, f"An error occurred during validation: {e}"
+        logging.error(f"Failed to process {image_path}: {e}")
+        file_record.update({"status": "error", "reason": str(e)})
+    return file_record
+
+
+def _read_prefetch(image_path: Path) -> Optional[bytes]:
+    """Reads an image's bytes for prefetching; on failure the worker re-reads it and
+    records the error."""
+    try:
+        return image_path.read_bytes()
+    except OSError:
+        return None
+
+
+def _pipelined_map(worker, image_files: list, executor: Executor) -> Iterator[dict]:
+    """
+    Runs worker over image_files on executor, overlapping file reads with processing.
+    
+    Reads run in a small thread pool and each image's bytes are handed to the
+    executor with its task, so workers never wait on the disk. No more than
+    PIPELINE_DEPTH images are read or in flight at any time.
+    
+    Args:
+        worker: Callable taking (image_path, stack_index, data=...).
+        image_files: The images to process; an image's stack index is its position.
+        executor: The executor that runs worker.
+        
+    Yields:
+        The worker's records, in the order of image_files.
+    """
+    pending = iter(enumerate(image_files))
+    reads = deque()
+    jobs = deque()
+    with ThreadPoolExecutor(max_workers=READ_THREADS) as reader:
+        def fill():
+            while len(reads) + len(jobs) < PIPELINE_DEPTH:
+                item = next(pending, None)
+                if item is None:
+                    return
+                index, path = item
+                reads.append((index, path, reader.submit(_read_prefetch, path)))
+
+        fill()
+        while reads or jobs:
+            # Hand every finished read to the executor, and wait on a read only
+            # when the executor has nothing else queued
+            while reads and (reads[0][2].done() or not jobs):
+                index, path, read = reads.popleft()
+                jobs.append(executor.submit(worker, path, index, data=read.result()))
+            fill()
+            yield jobs.popleft().result()
+            fill()
 
-def process_device_images(device_id: str, source_dir: Path, output_dir: Path, params: dict) -> list:
+
+def process_device_images(device_id: str, source_dir: Path, output_dir: Path, params: dict,
+                          executor: Optional[Executor] = None) -> list:
     """
     Processes all images for a single device.
     
@@ -62,6 +282,8 @@ def process_device_images(device_id: str, source_dir: Path, output_dir: Path, pa
         source_dir: The directory containing the raw images for this device.
         output_dir: The base directory to save processed noise patterns.
         params: A dictionary of processing parameters for forensic logging.
+        executor: Optional executor (e.g. a process pool) to process the images in
+            parallel; images are processed serially in this process if omitted.
         
     Returns:
         A list of metadata dictionaries for each processed image.
@@ -72,60 +294,58 @@ def process_device_images(device_id: str, source_dir: Path, output_dir: Path, pa
     image_files = list(source_dir.glob('*.jpg')) + list(source_dir.glob('*.jpeg')) + list(source_dir.glob('*.png'))
     logging.info(f"Found {len(image_files)} images for device '{device_id}'.")
 
-    device_metadata = []
-
-    for image_path in tqdm(image_files, desc=f"Processing {device_id}"):
-        file_record = {
-            "source_path": str(image_path),
-            "device_id": device_id,
-            "input_sha256": calculate_sha256(image_path)
-        }
-
-        is_valid, reason = validate_image(image_path, params['min_resolution'])
-        if not is_valid:
-            logging.warning(f"Skipping invalid image {image_path}: {reason}")
-            file_record.update({"status": "rejected", "reason": reason})
-            device_metadata.append(file_record)
-            continue
-
-        try:
-            # 1. Standardization
-            img_gray = cv2.imread(str(image_path), cv2.IMREAD_GRAYSCALE)
-            img_standard = cv2.resize(
-                img_gray, 
-                (params['target_size'], params['target_size']), 
-                interpolation=cv2.INTER_LANCZOS4
-            )
+    # Preallocate the device's residual stack; workers fill it in place
+    size = params['target_size']
+    np.lib.format.open_memmap(
+        device_output_dir / RESIDUAL_STACK_FILENAME, mode='w+', dtype=np.float16,
+        shape=(len(image_files), size, size)
+    ).flush()
 
-            # 2. Denoising
-            img_denoised = cv2.fastNlMeansDenoising(
-                img_standard, 
-                h=params['denoising_h'],
-                templateWindowSize=7,
-                searchWindowSize=21
-            )
+    worker = partial(process_image, device_id=device_id, device_output_dir=device_output_dir, params=params)
+    indices = range(len(image_files))
+    if executor is None:
+        records = map(worker, image_files, indices)
+    else:
+        records = _pipelined_map(worker, image_files, executor)
+    return list(tqdm(records, total=len(image_files), desc=f"Processing {device_id}"))
+
+
+def compute_reference_fingerprint(device_id: str, device_output_dir: Path, device_metadata: list) -> dict:
+    """
+    Averages a device's processed residuals into its reference PRNU fingerprint.
+    
+    The residuals are read from the device's residual stack, so the mean is one
+    vectorized pass over a single contiguous file.
+    
+    Args:
+        device_id: The identifier for the camera device.
+        device_output_dir: The directory holding this device's noise patterns.
+        device_metadata: The records returned by process_device_images.
+        
+    Returns:
+        A manifest record for the device's stack and fingerprint files.
+    """
+    stack_path = device_output_dir / RESIDUAL_STACK_FILENAME
+    rows = np.array([r["stack_index"] for r in device_metadata if r["status"] == "processed"], dtype=np.intp)
+    device_record = {
+        "device_id": device_id,
+        "residual_stack_path": str(stack_path),
+        "residual_stack_sha256": calculate_sha256(stack_path),
+        "num_residuals": len(rows)
+    }
+    if len(rows) == 0:
+        logging.warning(f"No processed residuals for device '{device_id}'; no reference fingerprint computed.")
+        return device_record
 
-            # 3. Noise Residual Calculation
-            noise_residual = img_standard.astype(np.float32) - img_denoised.astype(np.float32)
-            
-            # 4. Save processed pattern
-            output_filename = f"{image_path.stem}.npy"
-            output_path = device_output_dir / output_filename
-            np.save(output_path, noise_residual)
-
-            file_record.update({
-                "status": "processed",
-                "output_path": str(output_path),
-                "output_sha256": calculate_sha256(output_path)
-            })
-            device_metadata.append(file_record)
-
-        except Exception as e:
-            logging.error(f"Failed to process {image_path}: {e}")
-            file_record.update({"status": "error", "reason": str(e)})
-            device_metadata.append(file_record)
-            
-    return device_metadata
+    stack = np.load(stack_path, mmap_mode='r')
+    fingerprint = stack[rows].mean(axis=0, dtype=np.float32)
+    fingerprint_path = device_output_dir / REFERENCE_FINGERPRINT_FILENAME
+    np.save(fingerprint_path, fingerprint)
+    device_record.update({
+        "reference_fingerprint_path": str(fingerprint_path),
+        "reference_fingerprint_sha256": calculate_sha256(fingerprint_path)
+    })
+    return device_record
 
 
 def main():
@@ -145,15 +365,19 @@ def main():
     run_params = {
         "target_size": 512,
         "min_resolution": 256,
-        "denoising_h": 10,
-        "interpolation_method": "LANCZOS4",
-        "denoising_filter": "fastNlMeansDenoising"
+        "denoising_sigma": 3.0,
+        "wavelet": "db4",
+        "wavelet_level": 4,
+        "interpolation_method": "AREA",
+        "denoising_filter": "wavelet_wiener",
+        "residual_storage": "int8_symmetric"
     }
     logging.info(f"Starting preprocessing run with parameters: {json.dumps(run_params, indent=2)}")
 
     manifest = {
         "run_parameters": run_params,
-        "processed_files": []
+        "processed_files": [],
+        "device_fingerprints": []
     }
 
     device_dirs = [d for d in input_path.iterdir() if d.is_dir()]
@@ -163,10 +387,15 @@ def main():
 
     logging.info(f"Found {len(device_dirs)} device directories to process.")
 
-    for device_dir in device_dirs:
-        device_id = device_dir.name
-        device_metadata = process_device_images(device_id, device_dir, output_path, run_params)
-        manifest["processed_files"].extend(device_metadata)
+    # One pool for the whole run; the images of every device are spread across all cores
+    with ProcessPoolExecutor(max_workers=os.cpu_count(), initializer=_init_worker) as executor:
+        for device_dir in device_dirs:
+            device_id = device_dir.name
+            device_metadata = process_device_images(device_id, device_dir, output_path, run_params, executor)
+            manifest["processed_files"].extend(device_metadata)
+            manifest["device_fingerprints"].append(
+                compute_reference_fingerprint(device_id, output_path / device_id, device_metadata)
+            )
 
     manifest_path = output_path / "_manifest.json"
     with open(manifest_path, 'w') as f:
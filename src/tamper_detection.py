@@ -1,6 +1,8 @@
 """
 Advanced tamper detection using multiple techniques
 """
+from typing import Dict
+
 import cv2
 import numpy as np
 from scipy import ndimage
@@ -34,12 +36,9 @@ class TamperDetector:
         """Perform Error Level Analysis (ELA)"""
         original = cv2.imread(image_path)
         
-        # Save image at specified quality
-        temp_path = 'temp_ela.jpg'
-        cv2.imwrite(temp_path, original, [cv2.IMWRITE_JPEG_QUALITY, self.ela_quality])
-        
-        # Load compressed image
-        compressed = cv2.imread(temp_path)
+        # Recompress at the specified quality in memory
+        _, encoded = cv2.imencode('.jpg', original, [cv2.IMWRITE_JPEG_QUALITY, self.ela_quality])
+        compressed = cv2.imdecode(encoded, cv2.IMREAD_COLOR)
         
         # Calculate difference
         diff = cv2.absdiff(original, compressed)
@@ -51,9 +50,6 @@ class TamperDetector:
         ela_variance = np.var(ela_image)
         ela_mean = np.mean(ela_image)
         
-        # Clean up
-        os.remove(temp_path)
-        
         return {
             'ela_variance': float(ela_variance),
             'ela_mean': float(ela_mean),
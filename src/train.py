@@ -1,17 +1,18 @@
 import argparse
 import json
 import logging
+import os
 import sys
 import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
 
 import numpy as np
 import torch
-import torch.nn as nn
+import torch.nn.functional as F
 import torch.optim as optim
 import torchvision.transforms as transforms
-from scipy.interpolate import interp1d
-from scipy.optimize import brentq
 from sklearn.metrics import roc_auc_score, roc_curve
 from torch.utils.data import DataLoader
 
@@ -19,7 +20,7 @@ from torch.utils.data import DataLoader
 sys.path.append(str(Path(__file__).resolve().parent))
 from dataset import PRNUDataset
 from model import PRNUModel
-from utils import calculate_sha256
+from utils import calculate_sha256, describe_sha256_backend
 
 def setup_logging(log_path: Path):
     """Sets up a logger to output to both console and a file."""
@@ -29,85 +30,142 @@ def setup_logging(log_path: Path):
         format="%(asctime)s [%(levelname)s] - %(message)s",
         handlers=[logging.FileHandler(log_path), logging.StreamHandler(sys.stdout)],
     )
-    logging.info(f"Logging initialized. Log file at: {log_path}")
+    logging.info("Logging initialized. Log file at: %s", log_path)
 
 def calculate_eer(y_true, y_scores):
     """Calculates the Equal Error Rate (EER)."""
     fpr, tpr, _ = roc_curve(y_true, y_scores, pos_label=1)
-    eer = brentq(lambda x: 1.0 - x - interp1d(fpr, tpr)(x), 0.0, 1.0)
-    return eer * 100
+    fnr = 1 - tpr
+    # ROC point where the false accept and false reject rates are closest
+    i = np.nanargmin(np.abs(fnr - fpr))
+    return float((fpr[i] + fnr[i]) / 2) * 100
 
-def train_epoch(model, dataloader, optimizer, triplet_loss, bce_loss, device):
+def to_device(batch, device, gpu_transform):
+    """Moves a deduplicated batch to the device and converts/normalizes the images there."""
+    images, *indices = batch
+    images = gpu_transform(images.to(device, non_blocking=True)).contiguous(memory_format=torch.channels_last)
+    return (images, *(idx.to(device, non_blocking=True) for idx in indices))
+
+def combined_loss(anchor_sig, pos_sig, neg_sig, pos_logit, neg_logit, margin):
+    """
+    Triplet margin loss plus the mean of the positive/negative BCE-with-logits terms.
+
+    Matches nn.TripletMarginLoss(margin) + nn.BCEWithLogitsLoss(), written as one
+    function so torch.compile can fuse the elementwise kernels.
+    """
+    d_pos = F.pairwise_distance(anchor_sig, pos_sig, eps=1e-6)
+    d_neg = F.pairwise_distance(anchor_sig, neg_sig, eps=1e-6)
+    loss_triplet = torch.clamp_min(margin + d_pos - d_neg, 0).mean()
+    loss_bce = (
+        F.binary_cross_entropy_with_logits(pos_logit, torch.ones_like(pos_logit)) +
+        F.binary_cross_entropy_with_logits(neg_logit, torch.zeros_like(neg_logit))
+    ) / 2
+    return loss_triplet + loss_bce
+
+def compute_losses(model, images, anchor_idx, positive_idx, negative_idx, loss_fn):
+    """Encodes each unique image once and computes the combined triplet and similarity loss."""
+    # Signature mode of forward(), so a torch.compile'd model runs its compiled graph
+    signatures = model(images)
+    anchor_sig, pos_sig, neg_sig = signatures[anchor_idx], signatures[positive_idx], signatures[negative_idx]
+    pos_similarity = model.compute_similarity(anchor_sig, pos_sig)
+    neg_similarity = model.compute_similarity(anchor_sig, neg_sig)
+
+    loss = loss_fn(anchor_sig, pos_sig, neg_sig, pos_similarity, neg_similarity)
+    return loss, pos_similarity, neg_similarity
+
+def autocast(device, amp_dtype):
+    """Returns the mixed-precision context for the forward pass (a no-op off CUDA)."""
+    return torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=device.type == "cuda")
+
+def train_epoch(model, dataloader, optimizer, loss_fn, device, gpu_transform, amp_dtype, scaler):
     """Trains the model for one epoch."""
     model.train()
     total_loss = 0.0
-    for anchor, positive, negative in dataloader:
-        anchor, positive, negative = (t.to(device) for t in [anchor, positive, negative])
+    for batch in dataloader:
+        images, anchor_idx, positive_idx, negative_idx = to_device(batch, device, gpu_transform)
         optimizer.zero_grad()
-        pos_similarity, anchor_sig, pos_sig = model(anchor, positive)
-        neg_similarity, _, neg_sig = model(anchor, negative)
-        
-        loss_triplet = triplet_loss(anchor_sig, pos_sig, neg_sig)
-        loss_bce = (
-            bce_loss(pos_similarity, torch.ones_like(pos_similarity)) +
-            bce_loss(neg_similarity, torch.zeros_like(neg_similarity))
-        ) / 2
-        
-        combined_loss = loss_triplet + loss_bce
-        combined_loss.backward()
-        optimizer.step()
+        with autocast(device, amp_dtype):
+            combined_loss, _, _ = compute_losses(
+                model, images, anchor_idx, positive_idx, negative_idx, loss_fn
+            )
+        # The scaler is only enabled for float16; with bfloat16 these are plain calls
+        scaler.scale(combined_loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
         total_loss += combined_loss.item()
         
     return total_loss / len(dataloader)
 
-def validate_epoch(model, dataloader, triplet_loss, bce_loss, device):
+def validate_epoch(model, dataloader, loss_fn, device, gpu_transform, amp_dtype):
     """Validates the model for one epoch."""
     model.eval()
-    total_loss = 0.0
-    all_targets, all_scores = [], []
+    # Accumulate on the device and copy to the host once, after the last batch
+    max_scores = 2 * len(dataloader.dataset)
+    all_scores = torch.empty(max_scores, dtype=torch.float32, device=device)
+    all_targets = torch.empty(max_scores, dtype=torch.uint8, device=device)
+    total_loss = torch.zeros((), dtype=torch.float32, device=device)
+    offset = 0
     with torch.no_grad():
-        for anchor, positive, negative in dataloader:
-            anchor, positive, negative = (t.to(device) for t in [anchor, positive, negative])
-            pos_similarity, anchor_sig, pos_sig = model(anchor, positive)
-            neg_similarity, _, neg_sig = model(anchor, negative)
-
-            loss_triplet = triplet_loss(anchor_sig, pos_sig, neg_sig)
-            loss_bce = (
-                bce_loss(pos_similarity, torch.ones_like(pos_similarity)) +
-                bce_loss(neg_similarity, torch.zeros_like(neg_similarity))
-            ) / 2
+        for batch in dataloader:
+            images, anchor_idx, positive_idx, negative_idx = to_device(batch, device, gpu_transform)
+            with autocast(device, amp_dtype):
+                loss, pos_similarity, neg_similarity = compute_losses(
+                    model, images, anchor_idx, positive_idx, negative_idx, loss_fn
+                )
+            total_loss += loss.float()
             
-            total_loss += (loss_triplet + loss_bce).item()
-            
-            all_scores.extend(pos_similarity.cpu().numpy().flatten())
-            all_scores.extend(neg_similarity.cpu().numpy().flatten())
-            all_targets.extend([1] * len(pos_similarity))
-            all_targets.extend([0] * len(neg_similarity))
+            # Logits are monotonic in the score, so they rank identically for ROC/EER
+            n = pos_similarity.shape[0]
+            all_scores[offset:offset + n] = pos_similarity.flatten()
+            all_targets[offset:offset + n] = 1
+            all_scores[offset + n:offset + 2 * n] = neg_similarity.flatten()
+            all_targets[offset + n:offset + 2 * n] = 0
+            offset += 2 * n
 
-    avg_loss = total_loss / len(dataloader)
+    avg_loss = total_loss.item() / len(dataloader)
+    all_scores = all_scores[:offset].cpu().numpy()
+    all_targets = all_targets[:offset].cpu().numpy()
     roc_auc = roc_auc_score(all_targets, all_scores)
     eer = calculate_eer(all_targets, all_scores)
     return avg_loss, roc_auc, eer
 
-def save_checkpoint(model, optimizer, epoch, metrics, filepath: Path):
-    """Saves a model checkpoint dictionary."""
-    torch.save({
+def to_cpu(obj):
+    """Recursively copies tensors in a (nested) state dict to CPU memory."""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    return obj
+
+def checkpoint_state(model, optimizer, epoch, metrics):
+    """Builds a checkpoint dictionary that no longer aliases the live training tensors."""
+    return {
         'epoch': epoch,
-        'model_state_dict': model.state_dict(),
-        'optimizer_state_dict': optimizer.state_dict(),
-        'metrics': metrics
-    }, filepath)
-    logging.info(f"Checkpoint saved to {filepath}")
+        'model_state_dict': to_cpu(model.state_dict()),
+        'optimizer_state_dict': to_cpu(optimizer.state_dict()),
+        'metrics': dict(metrics)
+    }
+
+def save_checkpoint(checkpoint, filepath: Path):
+    """Saves a model checkpoint dictionary."""
+    torch.save(checkpoint, filepath, _use_new_zipfile_serialization=True)
+    logging.info("Checkpoint saved to %s", filepath)
 
 def main():
     """Main refactored training function with forensic manifest generation."""
     parser = argparse.ArgumentParser(description="Train PRNU forensic model with auditable manifest generation.")
-    parser.add_argument("--train_json_path", type=str, required=True, help="Path to training triplets JSON.")
-    parser.add_argument("--val_json_path", type=str, required=True, help="Path to validation triplets JSON.")
+    parser.add_argument("--train_json_path", type=str, required=True, help="Path to training triplets JSON or NDJSON.")
+    parser.add_argument("--val_json_path", type=str, required=True, help="Path to validation triplets JSON or NDJSON.")
     parser.add_argument("--output_dir", type=str, default="models", help="Root directory to save training runs.")
     parser.add_argument("--epochs", type=int, default=50, help="Number of training epochs.")
     parser.add_argument("--batch_size", type=int, default=16, help="Batch size for training.")
     parser.add_argument("--learning_rate", type=float, default=1e-4, help="Initial learning rate.")
+    parser.add_argument("--num_workers", type=int, default=max(1, (os.cpu_count() or 2) // 2), help="DataLoader worker processes.")
+    parser.add_argument("--cache_dir", type=str, default=None, help="Directory for memory-mapped caches of the decoded, resized images.")
+    parser.add_argument("--no_compile", action="store_true", help="Disable torch.compile of the model on CUDA.")
+    parser.add_argument("--gpu_decode", action="store_true", help="Decode JPEGs on the GPU (NVJPEG). Disables DataLoader workers.")
     args = parser.parse_args()
 
     # --- 1. Setup Run Environment and Manifest ---
@@ -118,9 +176,11 @@ def main():
     setup_logging(run_output_dir / "_log.txt")
     
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    logging.info(f"Starting new training run: {run_timestamp}")
-    logging.info(f"Output will be saved to: {run_output_dir}")
-    logging.info(f"Using device: {device}")
+    amp_dtype = torch.bfloat16 if device.type == "cuda" and torch.cuda.is_bf16_supported() else torch.float16
+    logging.info("Starting new training run: %s", run_timestamp)
+    logging.info("Output will be saved to: %s", run_output_dir)
+    logging.info("Using device: %s", device)
+    logging.info("Hashing backend: %s", describe_sha256_backend())
 
     # --- 2. Define and Log All Parameters ---
     train_params = {
@@ -130,17 +190,22 @@ def main():
         "device": str(device),
         "loss_functions": {
             "triplet_margin_loss": {"margin": 1.0},
-            "binary_cross_entropy_loss": {}
+            "binary_cross_entropy_with_logits_loss": {}
         },
+        "mixed_precision": str(amp_dtype) if device.type == "cuda" else None,
         "optimizer": {
             "type": "AdamW",
-            "weight_decay": 1e-5
+            "weight_decay": 1e-5,
+            "fused": device.type == "cuda"
         },
+        "memory_format": "channels_last",
+        "torch_compile": {"mode": "max-autotune"} if device.type == "cuda" and not args.no_compile else None,
         "scheduler": {
             "type": "CosineAnnealingLR",
             "T_max": args.epochs
         },
         "transforms": {
+            "decoder": "torchvision.io",
             "resize": [224, 224],
             "normalization_mean": [0.485, 0.456, 0.406],
             "normalization_std": [0.229, 0.224, 0.225]
@@ -157,45 +222,87 @@ def main():
     manifest['inputs'].append({"path": str(val_json_path), "sha256": calculate_sha256(val_json_path)})
 
     # --- 4. Initialize Components ---
-    transform = transforms.Compose([
-        transforms.Resize(train_params['transforms']['resize']),
-        transforms.ToTensor(),
+    # The dataset only decodes and resizes (uint8); dtype conversion and
+    # normalization run on the device once the batch has been transferred.
+    transform = transforms.Resize(train_params['transforms']['resize'], antialias=True)
+    gpu_transform = transforms.Compose([
+        transforms.ConvertImageDtype(torch.float32),
         transforms.Normalize(mean=train_params['transforms']['normalization_mean'], 
                            std=train_params['transforms']['normalization_std'])
     ])
     
-    train_dataset = PRNUDataset(str(train_json_path), transform=transform)
-    val_dataset = PRNUDataset(str(val_json_path), transform=transform)
-    train_loader = DataLoader(train_dataset, batch_size=args.batch_size, shuffle=True, num_workers=4, pin_memory=True)
-    val_loader = DataLoader(val_dataset, batch_size=args.batch_size, shuffle=False, num_workers=4, pin_memory=True)
-
-    model = PRNUModel().to(device)
-    triplet_loss = nn.TripletMarginLoss(margin=train_params['loss_functions']['triplet_margin_loss']['margin'])
-    bce_loss = nn.BCELoss()
-    optimizer = optim.AdamW(model.parameters(), lr=args.learning_rate, weight_decay=train_params['optimizer']['weight_decay'])
+    # CUDA cannot be initialized inside forked DataLoader workers, so GPU decoding
+    # runs in the main process.
+    decode_device = device if args.gpu_decode else torch.device("cpu")
+    num_workers = 0 if args.gpu_decode else args.num_workers
+    loader_kwargs = {
+        "batch_size": args.batch_size,
+        "num_workers": num_workers,
+        "pin_memory": decode_device.type == "cpu",
+    }
+    if num_workers > 0:
+        # Keep workers alive across epochs instead of re-forking them every epoch
+        torch.multiprocessing.set_sharing_strategy('file_system')
+        loader_kwargs.update(persistent_workers=True, prefetch_factor=4)
+    
+    train_dataset = PRNUDataset(str(train_json_path), transform=transform, device=decode_device)
+    val_dataset = PRNUDataset(str(val_json_path), transform=transform, device=decode_device)
+    if args.cache_dir:
+        cache_dir = Path(args.cache_dir)
+        logging.info("Preparing image caches in %s", cache_dir)
+        train_dataset.build_cache(cache_dir / f"{train_json_path.stem}_images.npy")
+        val_dataset.build_cache(cache_dir / f"{val_json_path.stem}_images.npy")
+    train_loader = DataLoader(train_dataset, shuffle=True, drop_last=True, collate_fn=train_dataset.collate_fn, **loader_kwargs)
+    val_loader = DataLoader(val_dataset, shuffle=False, collate_fn=val_dataset.collate_fn, **loader_kwargs)
+
+    # NHWC lets cuDNN pick its tensor-core convolution kernels
+    model = PRNUModel().to(device, memory_format=torch.channels_last)
+    # Train through the compiled wrapper but checkpoint the original module so
+    # state_dict keys stay loadable by inference.py.
+    train_model = model
+    if train_params['torch_compile']:
+        logging.info("Compiling model with torch.compile (mode=max-autotune)")
+        train_model = torch.compile(model, mode=train_params['torch_compile']['mode'], fullgraph=False)
+    loss_fn = combined_loss
+    if train_params['torch_compile']:
+        loss_fn = torch.compile(combined_loss, fullgraph=True, dynamic=False)
+    loss_fn = partial(loss_fn, margin=train_params['loss_functions']['triplet_margin_loss']['margin'])
+    optimizer = optim.AdamW(model.parameters(), lr=args.learning_rate, weight_decay=train_params['optimizer']['weight_decay'],
+                            fused=train_params['optimizer']['fused'])
     scheduler = optim.lr_scheduler.CosineAnnealingLR(optimizer, T_max=args.epochs)
+    scaler = torch.amp.GradScaler("cuda", enabled=device.type == "cuda" and amp_dtype == torch.float16)
 
     # --- 5. Training Loop ---
     best_roc_auc = 0.0
+    checkpoint_executor = ThreadPoolExecutor(max_workers=1)
+    checkpoint_future = None
     training_history = []
     logging.info("Starting training loop...")
     for epoch in range(args.epochs):
-        logging.info(f"\n--- Epoch {epoch + 1}/{args.epochs} ---")
-        train_loss = train_epoch(model, train_loader, optimizer, triplet_loss, bce_loss, device)
-        val_loss, roc_auc, eer = validate_epoch(model, val_loader, triplet_loss, bce_loss, device)
+        logging.info("\n--- Epoch %d/%d ---", epoch + 1, args.epochs)
+        train_loss = train_epoch(train_model, train_loader, optimizer, loss_fn, device, gpu_transform, amp_dtype, scaler)
+        val_loss, roc_auc, eer = validate_epoch(train_model, val_loader, loss_fn, device, gpu_transform, amp_dtype)
         scheduler.step()
 
         metrics = {'train_loss': train_loss, 'val_loss': val_loss, 'roc_auc': roc_auc, 'eer': eer}
         training_history.append({'epoch': epoch + 1, **metrics})
-        logging.info(f"Validation Metrics: ROC-AUC={roc_auc:.4f}, EER={eer:.2f}%, Loss={val_loss:.4f}")
+        logging.info("Validation Metrics: ROC-AUC=%.4f, EER=%.2f%%, Loss=%.4f", roc_auc, eer, val_loss)
 
         if roc_auc > best_roc_auc:
             best_roc_auc = roc_auc
             best_model_path = run_output_dir / "best_model.pth"
-            save_checkpoint(model, optimizer, epoch + 1, metrics, best_model_path)
+            # Snapshot on the training thread, serialize and write in the background
+            if checkpoint_future is not None:
+                checkpoint_future.result()
+            checkpoint_future = checkpoint_executor.submit(
+                save_checkpoint, checkpoint_state(model, optimizer, epoch + 1, metrics), best_model_path
+            )
 
     # --- 6. Finalize and Hash Outputs ---
     logging.info("\nTraining complete. Finalizing run artifacts...")
+    checkpoint_executor.shutdown(wait=True)
+    if checkpoint_future is not None:
+        checkpoint_future.result()
     
     history_path = run_output_dir / "training_history.json"
     with open(history_path, 'w') as f:
@@ -214,8 +321,8 @@ def main():
     with open(manifest_path, 'w') as f:
         json.dump(manifest, f, indent=4)
         
-    logging.info(f"Run manifest saved to {manifest_path}")
-    logging.info(f"--- Run {run_timestamp} Finished ---")
+    logging.info("Run manifest saved to %s", manifest_path)
+    logging.info("--- Run %s Finished ---", run_timestamp)
 
 if __name__ == "__main__":
     main()
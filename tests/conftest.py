@@ -0,0 +1,8 @@
+import sys
+from pathlib import Path
+
+# Modules are imported as they are in the app (``from src.utils import ...``),
+# while train/inference/dataset import their siblings directly
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(PROJECT_ROOT))
+sys.path.insert(0, str(PROJECT_ROOT / "src"))
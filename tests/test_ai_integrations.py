@@ -0,0 +1,137 @@
+import asyncio
+
+import pytest
+from cachetools import LRUCache
+
+from src import ai_integrations
+from src.ai_integrations import NarrativeBatcher
+
+
+def _findings(status):
+    return [{"level": 1, "finding": "Integrity check", "status": status, "reason": "test"}]
+
+
+def test_narrative_batcher_coalesces_concurrent_requests(monkeypatch):
+    calls = []
+    original = ai_integrations.generate_forensic_narratives
+
+    def counting_generate(findings_by_file):
+        calls.append(list(findings_by_file))
+        return original(findings_by_file)
+
+    monkeypatch.setattr(ai_integrations, "generate_forensic_narratives", counting_generate)
+
+    async def run():
+        batcher = NarrativeBatcher(max_findings=50, max_delay=0.05)
+        return await asyncio.gather(
+            batcher.submit("a.jpg", _findings("FLAGGED")),
+            batcher.submit("b.jpg", _findings("CLEAN")),
+            batcher.submit("a.jpg", _findings("CLEAN")),
+        )
+
+    narratives = asyncio.run(run())
+
+    assert len(calls) == 1
+    assert len(calls[0]) == 3
+    assert "Potential issues detected" in narratives[0]
+    assert "No significant tampering" in narratives[1]
+    assert "No significant tampering" in narratives[2]
+
+
+def test_narrative_batcher_splits_at_max_findings(monkeypatch):
+    calls = []
+    original = ai_integrations.generate_forensic_narratives
+
+    def counting_generate(findings_by_file):
+        calls.append(len(findings_by_file))
+        return original(findings_by_file)
+
+    monkeypatch.setattr(ai_integrations, "generate_forensic_narratives", counting_generate)
+
+    async def run():
+        batcher = NarrativeBatcher(max_findings=2, max_delay=0.05)
+        return await asyncio.gather(*(batcher.submit(f"{i}.jpg", _findings("CLEAN")) for i in range(4)))
+
+    narratives = asyncio.run(run())
+
+    assert calls == [2, 2]
+    assert len(narratives) == 4
+
+
+def test_generate_forensic_narrative_single_file():
+    narrative = ai_integrations.generate_forensic_narrative(_findings("FLAGGED"))
+    assert narrative.startswith("Mock AI Narrative")
+
+
+@pytest.fixture
+def profile_calls(tmp_path, monkeypatch):
+    calls = []
+    monkeypatch.setattr(ai_integrations, "PROFILE_CACHE_PATH", tmp_path / "profile_cache.sqlite")
+    monkeypatch.setattr(ai_integrations, "_profile_cache", LRUCache(maxsize=16))
+
+    def fake_generate(metadata):
+        calls.append(metadata)
+        return {"source": metadata.get("QuickTime:CompressorName") or metadata.get("EXIF:Model")}
+
+    monkeypatch.setattr(ai_integrations, "_generate_device_profile", fake_generate)
+    return calls
+
+
+def test_infer_device_profile_skips_cache_without_device_tags(profile_calls):
+    profiles = [
+        ai_integrations.infer_device_profile({"QuickTime:CompressorName": "HEVC"}),
+        ai_integrations.infer_device_profile({"QuickTime:CompressorName": "H.264 GoPro"}),
+        ai_integrations.infer_device_profile({}),
+    ]
+
+    assert [p["source"] for p in profiles] == ["HEVC", "H.264 GoPro", None]
+    assert len(profile_calls) == 3
+
+
+def test_infer_device_profile_caches_by_prompt_tags(profile_calls):
+    pixel = {"EXIF:Make": "Google", "EXIF:Model": "Pixel 8", "File:FileType": "JPEG"}
+
+    first = ai_integrations.infer_device_profile(pixel)
+    again = ai_integrations.infer_device_profile(dict(pixel))
+    # Same device, but a prompt tag differs: it must not reuse the cached profile
+    other = ai_integrations.infer_device_profile({**pixel, "File:FileType": "HEIC"})
+
+    assert first == again == other == {"source": "Pixel 8"}
+    assert len(profile_calls) == 2
+
+
+def test_infer_device_profile_persists_across_processes(profile_calls, monkeypatch):
+    pixel = {"EXIF:Make": "Google", "EXIF:Model": "Pixel 8"}
+    ai_integrations.infer_device_profile(pixel)
+
+    # A fresh in-memory layer still finds the profile in the sqlite cache
+    monkeypatch.setattr(ai_integrations, "_profile_cache", LRUCache(maxsize=16))
+    assert ai_integrations.infer_device_profile(pixel) == {"source": "Pixel 8"}
+    assert len(profile_calls) == 1
+
+
+def test_narrative_batcher_fails_batch_and_recovers(monkeypatch):
+    original = ai_integrations.generate_forensic_narratives
+    failures = [RuntimeError("model unavailable")]
+
+    def flaky_generate(findings_by_file):
+        if failures:
+            raise failures.pop()
+        return original(findings_by_file)
+
+    monkeypatch.setattr(ai_integrations, "generate_forensic_narratives", flaky_generate)
+
+    async def run():
+        batcher = NarrativeBatcher(max_delay=0.01)
+        failed = await asyncio.wait_for(asyncio.gather(
+            batcher.submit("a.jpg", _findings("CLEAN")),
+            batcher.submit("b.jpg", _findings("CLEAN")),
+            return_exceptions=True,
+        ), timeout=5)
+        recovered = await asyncio.wait_for(batcher.submit("c.jpg", _findings("CLEAN")), timeout=5)
+        return failed, recovered
+
+    failed, recovered = asyncio.run(run())
+
+    assert all(isinstance(result, RuntimeError) for result in failed)
+    assert recovered.startswith("Mock AI Narrative")
@@ -0,0 +1,123 @@
+import hashlib
+import os
+
+import cv2
+import numpy as np
+import pytest
+from fastapi.testclient import TestClient
+
+from conftest import PROJECT_ROOT
+
+
+@pytest.fixture(scope="module")
+def main(tmp_path_factory):
+    # The app mounts app/static relative to the working directory
+    cwd = os.getcwd()
+    os.chdir(PROJECT_ROOT)
+    try:
+        import app.main as main
+    finally:
+        os.chdir(cwd)
+    root = tmp_path_factory.mktemp("app")
+    main.UPLOAD_DIR = root / "uploads"
+    main.UPLOAD_DIR.mkdir()
+    main.PRNU_TRAINING_DIR = root / "raw"
+    return main
+
+
+@pytest.fixture(scope="module")
+def client(main):
+    # One client for the module: the narrative batcher lives on a single event loop
+    with TestClient(main.app) as client:
+        yield client
+
+
+def _jpeg(size=64):
+    img = np.random.default_rng(0).integers(0, 255, (size, size, 3), dtype=np.uint8)
+    return cv2.imencode(".jpg", img)[1].tobytes()
+
+
+def test_analyze_metadata_in_memory(main, client):
+    data = _jpeg()
+    response = client.post("/analyze-metadata", files={"file": ("photo.jpg", data, "image/jpeg")})
+
+    assert response.status_code == 200
+    report = response.json()
+    assert report["hash_values"]["sha256"] == hashlib.sha256(data).hexdigest()
+    # Streams have no file system record
+    assert "file_path" not in report["file_info"]
+    assert report["forensic_narrative_ai_generated"].startswith("Mock AI Narrative")
+    assert list(main.UPLOAD_DIR.iterdir()) == []
+
+
+def test_analyze_metadata_on_disk(main, client, monkeypatch):
+    monkeypatch.setattr(main, "SPOOL_MAX_SIZE", 1024)
+    data = _jpeg(256)
+    assert len(data) > 1024
+    response = client.post("/analyze-metadata", files={"file": ("photo.jpg", data, "image/jpeg")})
+
+    assert response.status_code == 200
+    report = response.json()
+    assert report["hash_values"]["sha256"] == hashlib.sha256(data).hexdigest()
+    assert report["file_info"]["file_name"] == "photo.jpg"
+    assert "file_path" in report["file_info"]
+    # The spooled upload is removed once the report is built
+    assert list(main.UPLOAD_DIR.iterdir()) == []
+
+
+def test_analyze_metadata_without_file(client):
+    response = client.post("/analyze-metadata", data={"other": "value"})
+    assert response.status_code == 400
+
+
+def test_analyze_metadata_malformed_body(client):
+    response = client.post(
+        "/analyze-metadata",
+        content=b"--wrong\r\nnot a multipart body",
+        headers={"Content-Type": "multipart/form-data; boundary=expected"},
+    )
+    assert response.status_code == 400
+    assert response.json()["detail"].startswith("Malformed multipart upload")
+
+
+def test_upload_for_training_saves_images_and_skips_others(main, client):
+    data = _jpeg()
+    response = client.post(
+        "/upload-for-training",
+        data={"device_name": "Pixel/../8 Pro!"},
+        files=[
+            ("files", ("a.jpg", data, "image/jpeg")),
+            ("files", ("notes.txt", b"not an image", "text/plain")),
+        ],
+    )
+
+    assert response.status_code == 200
+    body = response.json()
+    device_dir = main.PRNU_TRAINING_DIR / "Pixel8 Pro"
+    assert body["saved_files"] == [str(device_dir / "a.jpg")]
+    assert (device_dir / "a.jpg").read_bytes() == data
+    assert not (device_dir / "notes.txt").exists()
+    report = body["metadata_analysis"][str(device_dir / "a.jpg")]
+    assert report["hash_values"]["sha256"] == hashlib.sha256(data).hexdigest()
+    assert list(main.UPLOAD_DIR.iterdir()) == []
+
+
+@pytest.mark.parametrize("device_name", ["", "../!!"])
+def test_upload_for_training_rejects_empty_device_name(main, client, device_name):
+    response = client.post(
+        "/upload-for-training",
+        data={"device_name": device_name},
+        files=[("files", ("a.jpg", _jpeg(), "image/jpeg"))],
+    )
+
+    assert response.status_code == 400
+    assert list(main.UPLOAD_DIR.iterdir()) == []
+
+
+def test_upload_for_training_without_images(client):
+    response = client.post(
+        "/upload-for-training",
+        data={"device_name": "cam"},
+        files=[("files", ("notes.txt", b"text", "text/plain"))],
+    )
+    assert response.status_code == 400
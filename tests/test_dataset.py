@@ -0,0 +1,93 @@
+import json
+
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+from torchvision import transforms
+
+from dataset import PRNUDataset
+
+DEVICES = ["cpu"] + (["cuda"] if torch.cuda.is_available() else [])
+
+
+def _write_images(tmp_path, size=(64, 48)):
+    rng = np.random.default_rng(0)
+    paths = {}
+    for name, fmt in (("a.jpg", "JPEG"), ("b.png", "PNG"), ("c.tiff", "TIFF")):
+        path = tmp_path / name
+        Image.fromarray(rng.integers(0, 255, (size[1], size[0], 3), dtype=np.uint8)).save(path, fmt)
+        paths[name] = str(path)
+    return paths
+
+
+def _write_triplets(tmp_path, paths):
+    triplets = [
+        {"anchor": paths["a.jpg"], "positive": paths["b.png"], "negative": paths["c.tiff"]},
+        {"anchor": paths["b.png"], "positive": paths["a.jpg"], "negative": paths["c.tiff"]},
+    ]
+    json_path = tmp_path / "triplets.json"
+    json_path.write_text(json.dumps(triplets))
+    return json_path
+
+
+@pytest.mark.parametrize("device", DEVICES)
+def test_collate_mixed_formats_on_one_device(tmp_path, device):
+    json_path = _write_triplets(tmp_path, _write_images(tmp_path))
+    dataset = PRNUDataset(str(json_path), device=device)
+
+    images, anchor_idx, positive_idx, negative_idx = dataset.collate_fn([dataset[0], dataset[1]])
+
+    assert images.shape == (3, 3, 48, 64)
+    assert images.device.type == device
+    assert images.dtype == torch.uint8
+    assert anchor_idx.tolist() == positive_idx.flip(0).tolist()
+    assert negative_idx.tolist() == [2, 2]
+
+
+@pytest.mark.parametrize("device", DEVICES)
+def test_load_image_returns_dataset_device(tmp_path, device):
+    paths = _write_images(tmp_path)
+    dataset = PRNUDataset(str(_write_triplets(tmp_path, paths)), device=device)
+
+    for path in paths.values():
+        assert dataset.load_image(path).device.type == device
+
+
+def _build(tmp_path, json_path, size):
+    dataset = PRNUDataset(str(json_path), transform=transforms.Resize(size, antialias=True))
+    dataset.build_cache(str(tmp_path / "cache" / "images.npy"))
+    return dataset
+
+
+def test_build_cache_reuses_matching_cache(tmp_path):
+    json_path = _write_triplets(tmp_path, _write_images(tmp_path))
+    first = _build(tmp_path, json_path, (32, 32))
+    mtime = first.cache_path.stat().st_mtime_ns
+
+    second = _build(tmp_path, json_path, (32, 32))
+
+    assert second.cache_path.stat().st_mtime_ns == mtime
+    assert torch.equal(second.get_image(0), first.get_image(0))
+
+
+def test_build_cache_rebuilds_when_transform_changes(tmp_path):
+    json_path = _write_triplets(tmp_path, _write_images(tmp_path))
+    _build(tmp_path, json_path, (32, 32))
+
+    dataset = _build(tmp_path, json_path, (16, 24))
+
+    assert dataset.cache.shape == (3, 3, 16, 24)
+    assert dataset.get_image(0).shape == (3, 16, 24)
+
+
+def test_build_cache_rebuilds_when_image_replaced(tmp_path):
+    paths = _write_images(tmp_path)
+    json_path = _write_triplets(tmp_path, paths)
+    _build(tmp_path, json_path, (32, 32))
+
+    Image.new("RGB", (64, 48), (255, 0, 0)).save(paths["b.png"])
+    dataset = _build(tmp_path, json_path, (32, 32))
+
+    row = dataset.image_index[paths["b.png"]]
+    assert dataset.get_image(row)[0].float().mean() == 255
@@ -0,0 +1,49 @@
+import importlib.util
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+# The script's file name is not a valid module name, so load it from its path
+SCRIPT_PATH = Path(__file__).resolve().parent.parent / "scripts" / "generate-triplets.py"
+_spec = importlib.util.spec_from_file_location("generate_triplets", SCRIPT_PATH)
+generate_triplets = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(generate_triplets)
+
+
+@pytest.mark.parametrize("image_counts", [[2, 2], [2, 3, 5], [7, 2, 2, 40]])
+def test_sample_triplet_indices_are_distinct_and_in_range(image_counts):
+    counts = np.array(image_counts)
+    rng = np.random.default_rng(0)
+
+    anchor_dev, anchor_idx, positive_idx, negative_dev, negative_idx = \
+        generate_triplets.sample_triplet_indices(counts, 20000, rng)
+
+    assert np.all(anchor_idx != positive_idx)
+    assert np.all(negative_dev != anchor_dev)
+    assert np.all((anchor_dev >= 0) & (anchor_dev < len(counts)))
+    assert np.all((negative_dev >= 0) & (negative_dev < len(counts)))
+    assert np.all((anchor_idx >= 0) & (anchor_idx < counts[anchor_dev]))
+    assert np.all((positive_idx >= 0) & (positive_idx < counts[anchor_dev]))
+    assert np.all((negative_idx >= 0) & (negative_idx < counts[negative_dev]))
+
+
+def test_sample_triplet_indices_cover_every_option():
+    counts = np.array([3, 4, 2])
+    anchor_dev, anchor_idx, positive_idx, negative_dev, _ = \
+        generate_triplets.sample_triplet_indices(counts, 20000, np.random.default_rng(1))
+
+    # Skipping past the excluded value must not starve the last index or device
+    for device, count in enumerate(counts):
+        mask = anchor_dev == device
+        assert set(anchor_idx[mask].tolist()) == set(range(count))
+        assert set(positive_idx[mask].tolist()) == set(range(count))
+        assert set(negative_dev[mask].tolist()) == set(range(len(counts))) - {device}
+
+
+def test_sample_triplet_indices_is_reproducible():
+    counts = np.array([3, 5])
+    first = generate_triplets.sample_triplet_indices(counts, 100, np.random.default_rng(42))
+    second = generate_triplets.sample_triplet_indices(counts, 100, np.random.default_rng(42))
+    for a, b in zip(first, second):
+        assert np.array_equal(a, b)
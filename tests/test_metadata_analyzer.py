@@ -0,0 +1,38 @@
+import io
+
+import cv2
+import numpy as np
+
+from metadata_analyzer import MetadataAnalyzer
+
+
+def _jpeg(size=64):
+    img = np.random.default_rng(0).integers(0, 255, (size, size, 3), dtype=np.uint8)
+    return cv2.imencode(".jpg", img)[1].tobytes()
+
+
+def test_perceptual_hash_is_fixed_width_hex(tmp_path):
+    path = tmp_path / "photo.jpg"
+    path.write_bytes(_jpeg())
+    analyzer = MetadataAnalyzer()
+
+    phash = analyzer.analyze_file(str(path))["perceptual_hash"]
+
+    assert len(phash) == 16
+    assert phash == phash.lower()
+    assert analyzer._calculate_perceptual_hash(str(path)) == int(phash, 16)
+    # File and stream reports agree, and the hex form round-trips the int
+    assert analyzer.analyze_stream(io.BytesIO(path.read_bytes()), "photo.jpg")["perceptual_hash"] == phash
+    assert MetadataAnalyzer.hamming_distance(phash, phash) == 0
+    assert MetadataAnalyzer.hamming_distance(phash, int(phash, 16) ^ 0b101) == 2
+
+
+def test_perceptual_hash_keeps_leading_zeros():
+    assert MetadataAnalyzer._format_perceptual_hash(0x1F) == "000000000000001f"
+    assert MetadataAnalyzer._format_perceptual_hash(None) is None
+
+
+def test_perceptual_hash_of_non_image(tmp_path):
+    path = tmp_path / "notes.jpg"
+    path.write_bytes(b"not an image")
+    assert MetadataAnalyzer().analyze_file(str(path))["perceptual_hash"] is None
@@ -0,0 +1,43 @@
+import torch
+import torch.nn.functional as F
+
+from model import dequantize_signatures, quantize_signatures, quantized_correlation
+
+
+def _signatures(n, seed):
+    return F.normalize(torch.randn(n, 256, generator=torch.Generator().manual_seed(seed)), dim=1)
+
+
+def test_quantize_round_trip_error_bound():
+    sigs = _signatures(8, 0)
+    quantized, scales = quantize_signatures(sigs)
+
+    assert quantized.dtype == torch.int8
+    assert scales.shape == (8, 1)
+    # Rounding to the nearest step loses at most half a step per element
+    error = (dequantize_signatures(quantized, scales) - sigs).abs()
+    assert (error <= scales / 2 + 1e-7).all()
+    # Each row's largest magnitude maps to +/-127
+    assert (quantized.abs().amax(dim=1) == 127).all()
+
+
+def test_quantize_zero_signature():
+    quantized, scales = quantize_signatures(torch.zeros(1, 256))
+    assert (quantized == 0).all()
+    assert torch.isfinite(scales).all()
+
+
+def test_quantized_correlation_matches_float():
+    sigs1, sigs2 = _signatures(5, 1), _signatures(7, 2)
+    q1, s1 = quantize_signatures(sigs1)
+    q2, s2 = quantize_signatures(sigs2)
+
+    expected = sigs1 @ sigs2.T
+    approx = quantized_correlation(q1, s1, q2, s2)
+    assert approx.shape == (5, 7)
+    # |a.b - a'.b'| <= |a|_1 |b - b'|_inf + |b'|_1 |a - a'|_inf
+    bound = sigs1.abs().sum(1, keepdim=True) * s2.T / 2 + s1 / 2 * dequantize_signatures(q2, s2).abs().sum(1)
+    assert ((approx - expected).abs() <= bound + 1e-6).all()
+    torch.testing.assert_close(approx, expected, rtol=0, atol=5e-3)
+    # Exact against the dequantized signatures
+    torch.testing.assert_close(approx, dequantize_signatures(q1, s1) @ dequantize_signatures(q2, s2).T)
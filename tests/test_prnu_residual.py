@@ -0,0 +1,40 @@
+import pytest
+import torch
+
+from prnu_residual import compute_residual_gpu, gaussian_kernel1d
+
+
+def _images(batch=2, size=32):
+    return torch.rand(batch, 1, size, size, generator=torch.Generator().manual_seed(0)) * 255
+
+
+def test_gaussian_kernel_is_normalized():
+    kernel = gaussian_kernel1d(1.5)
+    assert kernel.shape == (2 * 5 + 1,)
+    assert torch.isclose(kernel.sum(), torch.tensor(1.0))
+
+
+def test_residual_shape_and_default_dtype():
+    imgs = _images().to(torch.uint8)
+    residual = compute_residual_gpu(imgs, compile=False)
+    assert residual.shape == imgs.shape
+    assert residual.dtype == torch.float32
+
+
+def test_residual_of_flat_image_is_zero():
+    residual = compute_residual_gpu(torch.full((1, 1, 16, 16), 128.0), compile=False)
+    assert torch.allclose(residual, torch.zeros_like(residual))
+
+
+def test_compiled_matches_eager():
+    imgs = _images()
+    eager = compute_residual_gpu(imgs, compile=False)
+    compiled = compute_residual_gpu(imgs, compile=True)
+    assert compiled.dtype == eager.dtype
+    torch.testing.assert_close(compiled, eager, rtol=1e-4, atol=1e-4)
+
+
+@pytest.mark.parametrize("shape", [(32, 32), (2, 32, 32), (2, 3, 32, 32)])
+def test_residual_rejects_non_grayscale_batches(shape):
+    with pytest.raises(ValueError):
+        compute_residual_gpu(torch.zeros(shape), compile=False)